@@ -1,19 +1,84 @@
-from django.contrib import admin
-from jmespath import search
-
-from .models import StripePayment, PaymentMethod
-
-
-@admin.register(StripePayment)
-class StripePaymentAdmin(admin.ModelAdmin):
-    list_display = ['user','customer_id','payment_method_id','subscription_id','paid_until','status','is_cancel','no_of_subscriptions']
-    readonly_fields = ['user','customer_id','payment_method_id','subscription_id','paid_until','status','is_cancel','no_of_subscriptions']
-    search_fields = ['customer_id']
-
-
-@admin.register(PaymentMethod)
-class PaymentMethodAdmin(admin.ModelAdmin):
-    list_display = ['user','customer','token_id','payment_method_id','fingerprint','is_default','status']
-    readonly_fields = ['user','customer','token_id','payment_method_id','fingerprint','is_default','status']
-    search_fields = ['payment_method_id']
-
+import json
+
+from django.contrib import admin
+from django.utils.html import format_html, format_html_join
+from jmespath import search
+
+from .models import StripePayment, PaymentMethod, StripeOutbox, StripeWebhookEvent, RequestProfile, StripeIdempotencyKey, StripeEventLog
+from .eventlog import decompress
+
+
+@admin.register(StripePayment)
+class StripePaymentAdmin(admin.ModelAdmin):
+    list_display = ['user','customer_id','payment_method_id','subscription_id','paid_until','status','is_cancel','no_of_subscriptions']
+    readonly_fields = ['user','customer_id','payment_method_id','subscription_id','paid_until','status','is_cancel','no_of_subscriptions']
+    search_fields = ['customer_id']
+
+
+@admin.register(PaymentMethod)
+class PaymentMethodAdmin(admin.ModelAdmin):
+    list_display = ['user','customer','token_id','payment_method_id','fingerprint','is_default','status']
+    readonly_fields = ['user','customer','token_id','payment_method_id','fingerprint','is_default','status']
+    search_fields = ['payment_method_id']
+
+
+@admin.register(StripeOutbox)
+class StripeOutboxAdmin(admin.ModelAdmin):
+    list_display = ['operation','user_id','customer_id','status','attempts','available_at','created_at']
+    readonly_fields = ['operation','user_id','customer_id','status','attempts','available_at','last_error']
+    list_filter = ['operation','status']
+    search_fields = ['customer_id']
+
+
+@admin.register(StripeWebhookEvent)
+class StripeWebhookEventAdmin(admin.ModelAdmin):
+    list_display = ['event_id','type','customer_id','status','attempts','created_at']
+    readonly_fields = ['event_id','type','customer_id','shard','created','payload','status','attempts','available_at','last_error']
+    list_filter = ['type','status']
+    search_fields = ['event_id','customer_id']
+
+
+@admin.register(StripeIdempotencyKey)
+class StripeIdempotencyKeyAdmin(admin.ModelAdmin):
+    list_display = ['operation','scope','result_id','completed_at','created_at']
+    readonly_fields = ['operation','scope','key','result_id','last_error','completed_at']
+    list_filter = ['operation']
+    search_fields = ['scope','result_id']
+
+
+@admin.register(RequestProfile)
+class RequestProfileAdmin(admin.ModelAdmin):
+    list_display = ['method','path','status_code','duration_ms','db_count','db_ms','stripe_count','stripe_ms','created_at']
+    readonly_fields = ['method','path','endpoint','status_code','user_id','duration_ms','db_count','db_ms','stripe_count','stripe_ms','span_table','cprofile']
+    exclude = ['spans']
+    list_filter = ['method','status_code']
+    search_fields = ['path','endpoint']
+
+    def span_table(self, obj):
+        spans = json.loads(obj.spans or '[]')
+        rows = format_html_join('\n', '{:>9} ms  +{:>8} ms  {:<6} {}{}',
+                                ((span['start_ms'], span['duration_ms'], span['kind'], span['name'],
+                                  ' [%s]' % span['error'] if span['error'] else '') for span in spans))
+        return format_html('<pre>{}</pre>', rows)
+    span_table.short_description = 'Spans'
+
+
+@admin.register(StripeEventLog)
+class StripeEventLogAdmin(admin.ModelAdmin):
+    list_display = ['event_id','type','customer_id','partition','created','logged_at']
+    readonly_fields = ['event_id','type','customer_id','partition','created','event']
+    exclude = ['data']
+    list_filter = ['type','partition']
+    search_fields = ['event_id','customer_id']
+
+    def event(self, obj):
+        return format_html('<pre>{}</pre>', json.dumps(decompress(obj.data), indent=2))
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
@@ -1,14 +1,15 @@
-from django.urls import path, include
-from rest_framework.routers import DefaultRouter
-from . import views
-
-router = DefaultRouter()
-
-router.register('payment-method', views.PaymentMethodView,basename='payment_method')
-router.register('payment', views.StripePaymentView,basename='payment')
-
-urlpatterns = [
-    path('config/', views.Config.as_view()),
-    path('stripe-webhooks/', views.stripe_webhooks, name='stripe_webhooks'),
-    path('', include(router.urls)),
-]
+from django.urls import path, include
+from rest_framework.routers import DefaultRouter
+from . import views
+
+router = DefaultRouter()
+
+router.register('payment-method', views.PaymentMethodView,basename='payment_method')
+router.register('payment', views.StripePaymentView,basename='payment')
+
+urlpatterns = [
+    path('config/', views.Config.as_view()),
+    path('stripe-webhooks/', views.stripe_webhooks, name='stripe_webhooks'),
+    path('metrics/', views.stripe_metrics, name='stripe_metrics'),
+    path('', include(router.urls)),
+]
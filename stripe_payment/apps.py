@@ -1,11 +1,17 @@
-from django.apps import AppConfig
-
-
-class StripePaymentConfig(AppConfig):
-    name = 'stripe_payment'
-
-    def ready(self):
-        try:
-            import stripe_payment.signals
-        except ImportError:
-            pass
+from django.apps import AppConfig
+
+
+class StripePaymentConfig(AppConfig):
+    name = 'stripe_payment'
+
+    def ready(self):
+        try:
+            import stripe_payment.signals
+        except ImportError:
+            pass
+
+        from django.conf import settings
+        if getattr(settings, 'STRIPE_CATALOG_WARM_ON_STARTUP', False):
+            import threading
+            from stripe_payment.utils import warm_catalog
+            threading.Thread(target=warm_catalog, daemon=True).start()
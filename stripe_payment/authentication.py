@@ -0,0 +1,49 @@
+from django.utils.translation import ugettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from .models import StripePayment
+
+
+def get_header_token(request):
+    header_token = request.META.get('HTTP_AUTHORIZATION', None)
+    if header_token is None:
+        return None
+    parts = header_token.split()
+    if len(parts) != 2:
+        return None
+    return parts[1]
+
+
+def resolve_token(request, key):
+    # Token, user and stripe payment in one query, shared by PaymentMiddleware
+    # and StripeTokenAuthentication for the lifetime of the request.
+    resolved = getattr(request, '_stripe_token', None)
+    if resolved is not None and resolved[0] == key:
+        return resolved[1]
+    token = Token.objects.select_related('user', 'user__stripe_payment').filter(key=key).first()
+    request._stripe_token = (key, token)
+    return token
+
+
+def get_stripe_payment(user):
+    try:
+        return user.stripe_payment
+    except StripePayment.DoesNotExist:
+        return None
+
+
+class StripeTokenAuthentication(TokenAuthentication):
+
+    def authenticate(self, request):
+        self.http_request = request._request
+        return super().authenticate(request)
+
+    def authenticate_credentials(self, key):
+        token = resolve_token(self.http_request, key)
+        if token is None:
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+        return (token.user, token)
@@ -0,0 +1,208 @@
+import itertools
+import json
+import math
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import RequestFactory
+from django.urls import reverse
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from .cache import entitlement_cache
+from .fakestripe import sign_payload
+from .middleware import PaymentMiddleware
+from .models import StripePayment
+from .provisioning import provision_stripe_customer
+from .utils import catalog, create_stripe_subscription
+
+# End to end timings of the api/v1 endpoints and the middleware gate against
+# the fake stripe server. Run through the benchmark_stripe_payment command,
+# which sets up a throwaway test database.
+
+BenchmarkResult = namedtuple('BenchmarkResult', ['name', 'count', 'errors', 'p50', 'p95', 'p99', 'rps'])
+
+_serial = itertools.count(1)
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = int(math.ceil(pct / 100.0 * len(ordered))) - 1
+    return ordered[min(max(index, 0), len(ordered) - 1)]
+
+
+def run_benchmark(name, call, iterations, concurrency=1, setup=None):
+    # setup(i) runs before the clock starts and returns the arguments of call;
+    # call returns the http status of the request.
+    args = [setup(i) if setup else () for i in range(iterations)]
+
+    def timed(arg):
+        start = time.perf_counter()
+        try:
+            code = call(*arg)
+        except Exception as e:
+            print(e)
+            code = None
+        return time.perf_counter() - start, code
+
+    start = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='stripe-benchmark') as executor:
+            timings = list(executor.map(timed, args))
+    else:
+        timings = [timed(arg) for arg in args]
+    elapsed = time.perf_counter() - start
+
+    samples = [duration * 1000 for duration, code in timings]
+    errors = len([code for duration, code in timings if code is None or code >= 400])
+    return BenchmarkResult(name, len(samples), errors, percentile(samples, 50), percentile(samples, 95),
+                           percentile(samples, 99), len(samples) / elapsed if elapsed else 0.0)
+
+
+def api_root():
+    return reverse('stripe_webhooks')[:-len('stripe-webhooks/')]
+
+
+def card_number():
+    return '4000%012d' % next(_serial)
+
+
+def create_user(status=1, paid_until=None):
+    User = get_user_model()
+    n = next(_serial)
+    user = User.objects.create(**{
+        User.USERNAME_FIELD: 'benchmark-%s' % n,
+        'email': 'benchmark-%s@example.com' % n
+    })
+    # the post_save signal leaves a pending row, create its customer inline
+    stripe_customer = provision_stripe_customer(StripePayment.objects.select_related('user').get(user=user))
+    StripePayment.objects.filter(pk=stripe_customer.pk).update(
+        status=status, paid_until=paid_until if paid_until is not None else int(time.time()) + 3600)
+    Token.objects.get_or_create(user=user)
+    return user
+
+
+def create_client(user):
+    client = APIClient()
+    client.force_authenticate(user)
+    return client
+
+
+def create_card(client, root):
+    response = client.post(root + 'payment-method/', {
+        'number': card_number(), 'exp_month': 12, 'exp_year': 2030, 'cvc': 123
+    }, format='json')
+    if response.status_code != 201:
+        raise Exception('Benchmark card not created: %s' % response.content)
+    return response.data['payment_method_id']
+
+
+def payment_method_pk(user, payment_method_id):
+    return user.payment_method.get(payment_method_id=payment_method_id).pk
+
+
+def subscription_event(customer_id, subscription_id):
+    return json.dumps({
+        'id': 'evt_benchmark_%s' % next(_serial),
+        'object': 'event',
+        'type': 'customer.subscription.updated',
+        'created': int(time.time()),
+        'data': {'object': {
+            'id': subscription_id,
+            'object': 'subscription',
+            'customer': customer_id,
+            'status': 'active',
+            'current_period_end': int(time.time()) + 3600
+        }}
+    })
+
+
+def gated_view(request):
+    pass
+
+
+def benchmark_suite(iterations=100, concurrency=1, only=None):
+    entitlement_cache.clear()
+    catalog.clear()
+    root = api_root()
+    results = []
+
+    def bench(name, call, setup=None, sequential=False):
+        if only and not any(pattern in name for pattern in only):
+            return
+        results.append(run_benchmark(name, call, iterations, 1 if sequential else concurrency, setup))
+
+    user = create_user()
+    client = create_client(user)
+    for _ in range(3):
+        create_card(client, root)
+    payment_method_id = create_card(client, root)
+    pk = payment_method_pk(user, payment_method_id)
+    stripe_customer = StripePayment.objects.get(user=user)
+    stripe_customer.subscription_id = create_stripe_subscription(stripe_customer.customer_id, payment_method_id,
+                                                                 settings.STRIPE_ANNUAL_PRICE_PLAN_ID).id
+    stripe_customer.save()
+
+    bench('GET config/', lambda: client.get(root + 'config/').status_code)
+    bench('POST payment-method/',
+          lambda data: client.post(root + 'payment-method/', data, format='json').status_code,
+          setup=lambda i: ({'number': card_number(), 'exp_month': 12, 'exp_year': 2030, 'cvc': 123},))
+    bench('GET payment-method/', lambda: client.get(root + 'payment-method/').status_code)
+    bench('GET payment-method/<id>/', lambda: client.get(root + 'payment-method/%s/' % pk).status_code)
+    bench('GET payment-method/<id>/?live=1',
+          lambda: client.get(root + 'payment-method/%s/?live=1' % pk).status_code)
+    bench('PUT payment-method/<id>/',
+          lambda month: client.put(root + 'payment-method/%s/' % pk,
+                                   {'exp_month': month, 'exp_year': 2031}, format='json').status_code,
+          setup=lambda i: (i % 12 + 1,))
+    bench('DELETE payment-method/<id>/',
+          lambda card_pk: client.delete(root + 'payment-method/%s/' % card_pk).status_code,
+          setup=lambda i: (payment_method_pk(user, create_card(client, root)),))
+
+    def subscriber(i):
+        new_user = create_user(status=i % 2 - 1)
+        new_client = create_client(new_user)
+        return new_client, create_card(new_client, root)
+
+    bench('POST payment/',
+          lambda new_client, card: new_client.post(root + 'payment/', {'payment_method_id': card},
+                                                   format='json').status_code,
+          setup=subscriber)
+    bench('PUT payment/<id>/',
+          lambda is_cancel: client.put(root + 'payment/%s/' % stripe_customer.pk,
+                                       {'is_cancel': is_cancel}, format='json').status_code,
+          setup=lambda i: ((i + 1) % 2,), sequential=True)
+
+    def webhook(i):
+        payload = subscription_event(stripe_customer.customer_id, stripe_customer.subscription_id)
+        return payload, sign_payload(payload, settings.STRIPE_WEBHOOK_SIGNING_KEY)
+
+    bench('POST stripe-webhooks/',
+          lambda payload, signature: client.post(root + 'stripe-webhooks/', payload, content_type='application/json',
+                                                 HTTP_STRIPE_SIGNATURE=signature).status_code,
+          setup=webhook)
+
+    middleware = PaymentMiddleware(gated_view)
+    token = Token.objects.get(user=user).key
+    factory = RequestFactory()
+
+    def gate(request):
+        response = middleware.process_view(request, gated_view, (), {})
+        return 200 if response is None else response.status_code
+
+    gate_request = lambda i: (factory.get('/', HTTP_AUTHORIZATION='Token %s' % token),)
+    bench('middleware gate (cached)', gate, setup=gate_request)
+
+    def uncached_gate(request):
+        entitlement_cache.invalidate_token(token)
+        return gate(request)
+
+    bench('middleware gate (uncached)', uncached_gate, setup=gate_request, sequential=True)
+    connection.close()
+    return results
@@ -0,0 +1,122 @@
+import threading
+import time
+
+from django.conf import settings
+from stripe.error import APIConnectionError, APIError
+
+from .metrics import registry
+
+# Circuit breaker in front of every stripe helper. When too many calls of a
+# window fail for stripe's reasons (no connection, 5xx) or are too slow, it
+# opens and calls fail fast with CircuitOpenError instead of waiting out their
+# timeouts. After STRIPE_BREAKER_COOLDOWN one trial call decides whether it
+# closes again. Each process has its own breaker.
+
+CLOSED = 'closed'
+HALF_OPEN = 'half_open'
+OPEN = 'open'
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(APIConnectionError):
+    # the request never reached stripe, so it is safe to retry later
+
+    def __init__(self):
+        super().__init__('Stripe is unavailable, try again later.[SP-182]')
+
+
+def is_outage(error):
+    # declined cards, invalid requests and 429s say nothing about stripe's health
+    return isinstance(error, (APIConnectionError, APIError)) or (getattr(error, 'http_status', None) or 0) >= 500
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, error_rate=0.5, min_calls=10, window=30, slow_call=5, cooldown=30):
+        self.error_rate = error_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.slow_call = slow_call
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.opened_at = 0
+        self.trial_running = False
+        self._reset_window()
+        registry.set('stripe_payment_stripe_breaker_state', {}, STATE_VALUES[CLOSED])
+
+    def _reset_window(self):
+        self.window_start = time.monotonic()
+        self.calls = self.failures = 0
+
+    def _set_state(self, state):
+        if state != self.state:
+            registry.inc('stripe_payment_stripe_breaker_transitions_total', {'from': self.state, 'to': state})
+            registry.set('stripe_payment_stripe_breaker_state', {}, STATE_VALUES[state])
+            self.state = state
+
+    def _open(self):
+        self.opened_at = time.monotonic()
+        self._set_state(OPEN)
+
+    def allow(self):
+        # Raises CircuitOpenError, or returns whether the call is the trial of a half open breaker.
+        with self.lock:
+            if self.state == CLOSED:
+                return False
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                self._set_state(HALF_OPEN)
+                self.trial_running = False
+            if self.state == HALF_OPEN and not self.trial_running:
+                self.trial_running = True
+                return True
+            raise CircuitOpenError()
+
+    def record(self, duration, error, trial=False):
+        failed = is_outage(error) or duration >= self.slow_call
+        with self.lock:
+            if trial:
+                self.trial_running = False
+                if failed:
+                    self._open()
+                else:
+                    self._reset_window()
+                    self._set_state(CLOSED)
+                return
+            if self.state != CLOSED:
+                # started before the breaker opened
+                return
+            if time.monotonic() - self.window_start >= self.window:
+                self._reset_window()
+            self.calls += 1
+            self.failures += failed
+            if self.calls >= self.min_calls and self.failures >= self.calls * self.error_rate:
+                self._open()
+
+    def is_open(self):
+        with self.lock:
+            return self.state != CLOSED and (self.trial_running or time.monotonic() - self.opened_at < self.cooldown)
+
+
+_breaker = None
+_breaker_lock = threading.Lock()
+
+
+def get_breaker():
+    global _breaker
+    if not getattr(settings, 'STRIPE_BREAKER_ENABLED', True):
+        return None
+    with _breaker_lock:
+        if _breaker is None:
+            _breaker = CircuitBreaker(error_rate=getattr(settings, 'STRIPE_BREAKER_ERROR_RATE', 0.5),
+                                      min_calls=getattr(settings, 'STRIPE_BREAKER_MIN_CALLS', 10),
+                                      window=getattr(settings, 'STRIPE_BREAKER_WINDOW', 30),
+                                      slow_call=getattr(settings, 'STRIPE_BREAKER_SLOW_CALL', 5),
+                                      cooldown=getattr(settings, 'STRIPE_BREAKER_COOLDOWN', 30))
+        return _breaker
+
+
+def stripe_available():
+    # False while the breaker fails calls fast, callers that can degrade check it first
+    breaker = get_breaker()
+    return breaker is None or not breaker.is_open()
@@ -0,0 +1,131 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+class LRUCache(object):
+
+    def __init__(self, maxsize=10000, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class EntitlementCache(object):
+    # Two layers of keys: token -> owner and user -> entitlement (superuser flag
+    # and billing state). Webhooks and user changes only know the user, so the
+    # entitlement is invalidated per user while the token mapping stays warm.
+    token_prefix = 'stripe_payment:token:'
+    user_prefix = 'stripe_payment:user:v4:'
+
+    def __init__(self, maxsize=10000, local_ttl=30, alias=None, timeout=300):
+        self.local = LRUCache(maxsize, local_ttl)
+        self.alias = alias
+        self.timeout = timeout
+
+    @property
+    def shared(self):
+        if self.alias:
+            return caches[self.alias]
+        return None
+
+    def _get(self, key):
+        value = self.local.get(key)
+        if value is None and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.local.set(key, value)
+        return value
+
+    def _set(self, key, value):
+        self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(key, value, self.timeout)
+
+    def _delete(self, key):
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete(key)
+
+    def get(self, token):
+        owner = self._get(self.token_prefix + token)
+        if owner is None:
+            return None
+        entitlement = self._get(self.user_prefix + str(owner['user_id']))
+        if entitlement is None:
+            return None
+        return dict(owner, **entitlement)
+
+    def set(self, token, user, stripe_customer=None):
+        owner = {
+            'user_id': user.id
+        }
+        self._set(self.token_prefix + token, owner)
+        entitlement = {
+            'is_superuser': bool(user.is_superuser)
+        }
+        if not entitlement['is_superuser']:
+            entitlement.update(status=stripe_customer.status,
+                               paid_until=stripe_customer.paid_until,
+                               is_cancel=stripe_customer.is_cancel)
+        self._set(self.user_prefix + str(user.id), entitlement)
+        return dict(owner, **entitlement)
+
+    def invalidate_token(self, token):
+        self._delete(self.token_prefix + token)
+
+    def invalidate_user(self, user_id):
+        self._delete(self.user_prefix + str(user_id))
+
+    def clear(self):
+        self.local.clear()
+
+
+entitlement_cache = EntitlementCache(
+    maxsize=getattr(settings, 'STRIPE_ENTITLEMENT_CACHE_MAXSIZE', 10000),
+    local_ttl=getattr(settings, 'STRIPE_ENTITLEMENT_CACHE_LOCAL_TTL', 30),
+    alias=getattr(settings, 'STRIPE_ENTITLEMENT_CACHE_ALIAS', None),
+    timeout=getattr(settings, 'STRIPE_ENTITLEMENT_CACHE_TIMEOUT', 300),
+)
+
+
+def invalidate_entitlement(user_id):
+    entitlement_cache.invalidate_user(user_id)
+
+
+def invalidate_customer_entitlement(customer_id):
+    from .models import StripePayment
+    for user_id in StripePayment.objects.filter(customer_id=customer_id).values_list('user_id', flat=True):
+        entitlement_cache.invalidate_user(user_id)
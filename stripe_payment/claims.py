@@ -0,0 +1,56 @@
+import hashlib
+
+from django.conf import settings
+from django.core import signing
+
+# Short-lived signed entitlement claims. The response carries the claim in
+# CLAIM_HEADER; a client sending it back lets PaymentMiddleware decide without
+# a cache or DB lookup. A claim is bound to the auth token it was issued for
+# and outlives a subscription change by at most STRIPE_ENTITLEMENT_CLAIM_TTL.
+
+CLAIM_HEADER = 'X-Stripe-Entitlement'
+CLAIM_SALT = 'stripe_payment.entitlement'
+
+
+def claims_enabled():
+    return getattr(settings, 'STRIPE_ENTITLEMENT_CLAIMS', False)
+
+
+def _key():
+    return getattr(settings, 'STRIPE_ENTITLEMENT_CLAIM_KEY', None) or settings.SECRET_KEY
+
+
+def token_hash(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()[:32]
+
+
+def issue_claim(token, entitlement):
+    return signing.dumps({
+        't': token_hash(token),
+        'u': entitlement['user_id'],
+        'su': entitlement['is_superuser'],
+        's': entitlement.get('status'),
+        'p': entitlement.get('paid_until'),
+        'c': entitlement.get('is_cancel'),
+    }, key=_key(), salt=CLAIM_SALT, compress=True)
+
+
+def read_claim(request, token):
+    claim = request.META.get('HTTP_X_STRIPE_ENTITLEMENT')
+    if not claim:
+        return None
+    try:
+        data = signing.loads(claim, key=_key(), salt=CLAIM_SALT,
+                             max_age=getattr(settings, 'STRIPE_ENTITLEMENT_CLAIM_TTL', 300))
+    except signing.BadSignature:
+        # tampered, expired or signed with another key
+        return None
+    if data.get('t') != token_hash(token):
+        return None
+    return {
+        'user_id': data['u'],
+        'is_superuser': data['su'],
+        'status': data['s'],
+        'paid_until': data['p'],
+        'is_cancel': data['c'],
+    }
@@ -0,0 +1,229 @@
+import datetime
+import json
+import zlib
+from collections import Counter
+
+from django.db import transaction
+
+from .cache import invalidate_entitlement
+from .models import StripeEventLog, StripePayment, PaymentMethod, StripeWebhookEvent
+from .utils import payment_method_details
+
+# Every processed webhook event is appended to StripeEventLog, compressed and
+# partitioned by month. replay() rebuilds StripePayment and PaymentMethod
+# state from it without calling stripe: every customer starts from its row,
+# the log is streamed in created order through the state transitions of the
+# webhook handlers, then the fields that differ are bulk updated.
+
+REPLAYED_EVENTS = (
+    'charge.succeeded',
+    'customer.subscription.created',
+    'customer.subscription.updated',
+    'customer.subscription.deleted',
+    'customer.deleted',
+    'payment_method.updated',
+    'payment_method.automatically_updated',
+)
+CARD_FIELDS = ['brand', 'last4', 'exp_month', 'exp_year', 'funding', 'billing_details']
+
+
+def get_partition(created):
+    created = datetime.datetime.utcfromtimestamp(created or 0)
+    return created.year * 100 + created.month
+
+
+def compress(payload):
+    # stripe pretty prints its payloads, store them compact
+    return zlib.compress(json.dumps(json.loads(payload), separators=(',', ':')).encode('utf-8'))
+
+
+def decompress(data):
+    return json.loads(zlib.decompress(data).decode('utf-8'))
+
+
+def log_entry(event_id, type, customer_id, created, payload):
+    return StripeEventLog(event_id=event_id,
+                          type=type,
+                          customer_id=customer_id or '',
+                          partition=get_partition(created),
+                          created=created or 0,
+                          data=compress(payload))
+
+
+def log_stored_event(stored):
+    return log_entry(stored.event_id, stored.type, stored.customer_id, stored.created, stored.payload)
+
+
+def append_events(entries):
+    # Append only: an event id already logged is kept as it is.
+    try:
+        StripeEventLog.objects.bulk_create(entries, ignore_conflicts=True)
+    except Exception as e:
+        # losing history must not fail the webhook
+        print(e)
+
+
+def backfill_event_log(batch_size=1000):
+    # processed events stored before the log existed
+    last_pk = 0
+    count = 0
+    while True:
+        events = list(StripeWebhookEvent.objects.filter(status='1', pk__gt=last_pk).order_by('pk')[:batch_size])
+        if not events:
+            return count
+        append_events([log_stored_event(stored) for stored in events])
+        count += len(events)
+        last_pk = events[-1].pk
+
+
+def stream_events(customer_id=None, chunk_size=2000):
+    rows = StripeEventLog.objects.filter(type__in=REPLAYED_EVENTS).order_by('partition', 'created', 'id')
+    if customer_id:
+        rows = rows.filter(customer_id=customer_id)
+    for data in rows.values_list('data', flat=True).iterator(chunk_size=chunk_size):
+        yield decompress(data)
+
+
+def get_log_start():
+    # created time of the oldest logged event, older months may be archived
+    return StripeEventLog.objects.filter(created__gt=0).order_by('partition', 'created').values_list(
+        'created', flat=True).first()
+
+
+def deleted_subscriptions(customer_id=None):
+    # newest deleted subscription per customer
+    rows = StripeEventLog.objects.filter(type='customer.subscription.deleted').order_by('partition', 'created', 'id')
+    if customer_id:
+        rows = rows.filter(customer_id=customer_id)
+    return {customer: decompress(data)['data']['object']['id']
+            for customer, data in rows.values_list('customer_id', 'data').iterator()}
+
+
+def load_states(customer_id=None, log_start=None):
+    # Replay starts from the row. The subscription is the one the api view
+    # stored, which is not in the log: the row's, or once the handler
+    # cleared it the last deleted one. Rows the log covers from their
+    # creation on are recounted, older ones keep no_of_subscriptions and
+    # only take paid_until and status from their logged events.
+    from .webhooks import STATE_FIELDS
+    deleted = deleted_subscriptions(customer_id)
+    rows = StripePayment.objects.exclude(customer_id='')
+    if customer_id:
+        rows = rows.filter(customer_id=customer_id)
+    states = {}
+    for row in rows.values('customer_id', 'created_at', *STATE_FIELDS).iterator():
+        state = dict(row, last_event_at=None, deleted=False)
+        state['subscription_id'] = row['subscription_id'] or deleted.get(row['customer_id'], '')
+        state['complete'] = log_start is not None and row['created_at'].timestamp() >= log_start
+        if state['complete']:
+            state.update(no_of_subscriptions=0, paid_until=None)
+        states[row['customer_id']] = state
+    return states
+
+
+def replay_event(states, cards, periods, event, stats):
+    # The handlers' transitions of webhooks.py. A charge's period end comes
+    # from its expanded invoice, else from the last period logged for the
+    # customer's subscription, where the handler asks stripe for it. Charges
+    # without either, and one-off invoices, count as charges_unresolved and
+    # leave paid_until and status alone.
+    from .webhooks import (get_charge_period_end, charge_changes, subscription_updated_changes,
+                           subscription_deleted_changes)
+    obj = event['data']['object']
+    created = event.get('created')
+    if event['type'] in ('payment_method.updated', 'payment_method.automatically_updated'):
+        cards[obj['id']] = payment_method_details(obj)
+        return
+    if event['type'] == 'customer.deleted':
+        if obj['id'] in states:
+            states[obj['id']]['deleted'] = True
+        return
+    if event['type'].startswith('customer.subscription.'):
+        periods[obj['id']] = obj.get('current_period_end')
+    state = states.get(obj.get('customer'))
+    if state is None:
+        stats['missing'] += 1
+        return
+
+    if event['type'] == 'charge.succeeded':
+        period_end = get_charge_period_end(obj, state['subscription_id'], offline=True)
+        if not period_end and (not obj.get('invoice') or isinstance(obj['invoice'], str)):
+            period_end = periods.get(state['subscription_id'])
+        if not period_end:
+            stats['charges_unresolved'] += 1
+        state.update(charge_changes(state, period_end))
+    elif event['type'] == 'customer.subscription.deleted':
+        state.update(subscription_deleted_changes(state, obj, created))
+    else:
+        state.update(subscription_updated_changes(state, obj, created))
+
+
+def _chunks(values, size):
+    values = list(values)
+    for index in range(0, len(values), size):
+        yield values[index:index + size]
+
+
+def write_states(states, dry_run=False, batch_size=500):
+    # Only the fields the replay determined are written: the count of rows
+    # it covers completely, and paid_until and last_event_at once an event
+    # set them.
+    from .webhooks import STATE_FIELDS
+    stats = Counter()
+    for customer_ids in _chunks(states, batch_size):
+        rows = list(StripePayment.objects.filter(customer_id__in=customer_ids))
+        changed, fields = [], set()
+        for row in rows:
+            state = states[row.customer_id]
+            if state['deleted']:
+                # the handler deleted the row, a replay never does
+                stats['deleted'] += 1
+                continue
+            if not state['complete']:
+                stats['incomplete'] += 1
+            values = {field: state[field] for field in STATE_FIELDS
+                      if (field != 'no_of_subscriptions' or state['complete']) and
+                      (state[field] is not None or field not in ('paid_until', 'last_event_at'))}
+            values = {field: value for field, value in values.items() if getattr(row, field) != value}
+            if values:
+                for field, value in values.items():
+                    setattr(row, field, value)
+                changed.append(row)
+                fields.update(values)
+        stats['changed'] += len(changed)
+        if changed and not dry_run:
+            with transaction.atomic():
+                StripePayment.objects.bulk_update(changed, fields)
+            for row in changed:
+                invalidate_entitlement(row.user_id)
+    return stats
+
+
+def write_cards(cards, dry_run=False, batch_size=500):
+    changed = []
+    for payment_method_ids in _chunks(cards, batch_size):
+        for row in PaymentMethod.objects.filter(payment_method_id__in=payment_method_ids):
+            details = cards[row.payment_method_id]
+            if any(getattr(row, field) != details[field] for field in CARD_FIELDS):
+                for field in CARD_FIELDS:
+                    setattr(row, field, details[field])
+                changed.append(row)
+    if changed and not dry_run:
+        with transaction.atomic():
+            PaymentMethod.objects.bulk_update(changed, CARD_FIELDS, batch_size=batch_size)
+    return len(changed)
+
+
+def replay(customer_id=None, dry_run=False, chunk_size=2000, batch_size=500):
+    # Memory holds one small state per customer and card, not the events.
+    states = load_states(customer_id, get_log_start())
+    cards = {}
+    periods = {}
+    stats = Counter()
+    for event in stream_events(customer_id, chunk_size):
+        replay_event(states, cards, periods, event, stats)
+        stats['events'] += 1
+    stats['customers'] = len(states)
+    stats.update(write_states(states, dry_run, batch_size))
+    stats['cards_changed'] = write_cards(cards, dry_run, batch_size)
+    return stats
@@ -0,0 +1,350 @@
+import hashlib
+import hmac
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import stripe
+
+# In-process stand-in for the parts of the stripe API used by utils.py, with
+# configurable latency and error rate. Used by the benchmark and webhook load
+# commands, never in production.
+
+
+def sign_payload(payload, secret, timestamp=None):
+    # Stripe-Signature header as checked by stripe.Webhook.construct_event
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signature = hmac.new(secret.encode('utf-8'), ('%d.%s' % (timestamp, payload)).encode('utf-8'),
+                         hashlib.sha256).hexdigest()
+    return 't=%d,v1=%s' % (timestamp, signature)
+
+
+def parse_params(query):
+    # card[number]=..&items[0][price]=.. -> nested dicts and lists
+    params = {}
+    for key, value in parse_qsl(query, keep_blank_values=True):
+        parts = re.findall(r'[^\[\]]+|\[\]', key)
+        target = params
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value
+    return _listify(params)
+
+
+def _listify(value):
+    if not isinstance(value, dict):
+        return value
+    value = {key: _listify(item) for key, item in value.items()}
+    if value and all(key.isdigit() or key == '[]' for key in value):
+        return [value[key] for key in sorted(value, key=lambda key: int(key) if key.isdigit() else 0)]
+    return value
+
+
+class StripeAPIError(Exception):
+
+    def __init__(self, status, error_type, message, code=None):
+        super().__init__(message)
+        self.status = status
+        self.body = {'error': {'type': error_type, 'message': message, 'code': code}}
+
+
+class FakeStripe(object):
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, seed=None, trial_days=7):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.trial_days = trial_days
+        self.random = random.Random(seed)
+        self.objects = {}
+        self.idempotent = {}
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.server = None
+        self.url = None
+        self.previous = None
+        self.routes = [
+            ('POST', r'/v1/customers$', self.create_customer),
+            ('GET', r'/v1/customers$', self.list_customers),
+            ('GET', r'/v1/customers/(?P<id>[^/]+)$', self.retrieve),
+            ('POST', r'/v1/customers/(?P<id>[^/]+)$', self.modify),
+            ('DELETE', r'/v1/customers/(?P<id>[^/]+)$', self.delete_customer),
+            ('POST', r'/v1/tokens$', self.create_token),
+            ('GET', r'/v1/tokens/(?P<id>[^/]+)$', self.retrieve),
+            ('POST', r'/v1/payment_methods$', self.create_payment_method),
+            ('GET', r'/v1/payment_methods/(?P<id>[^/]+)$', self.retrieve),
+            ('POST', r'/v1/payment_methods/(?P<id>[^/]+)/attach$', self.attach_payment_method),
+            ('POST', r'/v1/payment_methods/(?P<id>[^/]+)/detach$', self.detach_payment_method),
+            ('POST', r'/v1/payment_methods/(?P<id>[^/]+)$', self.modify_payment_method),
+            ('GET', r'/v1/prices/(?P<id>[^/]+)$', self.retrieve_price),
+            ('GET', r'/v1/products/(?P<id>[^/]+)$', self.retrieve_product),
+            ('POST', r'/v1/subscriptions$', self.create_subscription),
+            ('GET', r'/v1/subscriptions$', self.list_subscriptions),
+            ('GET', r'/v1/subscriptions/(?P<id>[^/]+)$', self.retrieve),
+            ('POST', r'/v1/subscriptions/(?P<id>[^/]+)$', self.modify),
+            ('POST', r'/v1/payment_intents$', self.create_payment_intent),
+            ('GET', r'/v1/payment_intents/(?P<id>[^/]+)$', self.retrieve),
+            ('POST', r'/v1/payment_intents/(?P<id>[^/]+)/confirm$', self.confirm_payment_intent),
+            ('POST', r'/v1/payment_intents/(?P<id>[^/]+)$', self.modify),
+            ('GET', r'/v1/invoices/(?P<id>[^/]+)$', self.retrieve),
+        ]
+
+    # server
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _handle(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length).decode('utf-8') if length else ''
+                url = urlsplit(self.path)
+                status, response = fake.dispatch(self.command, url.path, parse_params(url.query or body),
+                                                 self.headers.get('Idempotency-Key'))
+                data = json.dumps(response).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_DELETE = _handle
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        if self.server is None:
+            self.start()
+        self.previous = stripe.api_base, stripe.api_key
+        stripe.api_base = self.url
+        stripe.api_key = stripe.api_key or 'sk_test_fake'
+        return self
+
+    def __exit__(self, *exc_info):
+        stripe.api_base, stripe.api_key = self.previous
+        self.stop()
+
+    def dispatch(self, method, path, params, idempotency_key=None):
+        with self.lock:
+            self.requests += 1
+        delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if self.error_rate and self.random.random() < self.error_rate:
+            return 500, {'error': {'type': 'api_error', 'message': 'Injected failure.'}}
+        if idempotency_key and (method, idempotency_key) in self.idempotent:
+            # stripe replays the first response of a key
+            return self.idempotent[(method, idempotency_key)]
+        for route_method, pattern, handler in self.routes:
+            match = re.match(pattern, path)
+            if route_method == method and match:
+                try:
+                    with self.lock:
+                        response = 200, handler(params, **match.groupdict())
+                except StripeAPIError as e:
+                    response = e.status, e.body
+                if idempotency_key and method == 'POST':
+                    self.idempotent[(method, idempotency_key)] = response
+                return response
+        return 404, {'error': {'type': 'invalid_request_error', 'message': 'Unrecognized request URL.'}}
+
+    # objects
+
+    def new_id(self, prefix):
+        return '%s_%06d' % (prefix, next(self.ids))
+
+    def add(self, obj):
+        obj.setdefault('created', int(time.time()))
+        self.objects[obj['id']] = obj
+        return obj
+
+    def get(self, object_id):
+        if object_id not in self.objects:
+            raise StripeAPIError(404, 'invalid_request_error', 'No such object: %s' % object_id, 'resource_missing')
+        return self.objects[object_id]
+
+    def expand(self, obj, params):
+        obj = dict(obj)
+        for field in params.get('expand') or []:
+            if isinstance(obj.get(field), str):
+                obj[field] = self.get(obj[field])
+        return obj
+
+    def retrieve(self, params, id):
+        return self.expand(self.get(id), params)
+
+    def modify(self, params, id):
+        obj = self.get(id)
+        for key, value in params.items():
+            if key == 'expand':
+                continue
+            if isinstance(value, dict) and isinstance(obj.get(key), dict):
+                obj[key].update(value)
+            elif value in ('true', 'false'):
+                obj[key] = value == 'true'
+            else:
+                obj[key] = value
+        return obj
+
+    def list_objects(self, prefix, params):
+        items = sorted((obj for obj in self.objects.values() if obj['object'] == prefix),
+                       key=lambda obj: (obj['created'], obj['id']), reverse=True)
+        created = params.get('created') or {}
+        if 'gte' in created:
+            items = [obj for obj in items if obj['created'] >= int(created['gte'])]
+        if 'lt' in created:
+            items = [obj for obj in items if obj['created'] < int(created['lt'])]
+        if params.get('starting_after'):
+            ids = [obj['id'] for obj in items]
+            items = items[ids.index(params['starting_after']) + 1:] if params['starting_after'] in ids else []
+        limit = int(params.get('limit') or 10)
+        return {'object': 'list', 'url': '/v1/%ss' % prefix, 'data': items[:limit], 'has_more': len(items) > limit}
+
+    def card(self, card):
+        number = card.get('number', '4242424242424242')
+        return {
+            'brand': 'visa',
+            'last4': number[-4:],
+            'exp_month': int(card.get('exp_month') or 12),
+            'exp_year': int(card.get('exp_year') or 2030),
+            'funding': 'credit',
+            'fingerprint': hashlib.sha1(number.encode('utf-8')).hexdigest()[:16]
+        }
+
+    def create_customer(self, params):
+        return self.add({
+            'id': self.new_id('cus'),
+            'object': 'customer',
+            'name': params.get('name'),
+            'email': params.get('email'),
+            'metadata': params.get('metadata') or {},
+            'invoice_settings': {'default_payment_method': None}
+        })
+
+    def list_customers(self, params):
+        return self.list_objects('customer', params)
+
+    def delete_customer(self, params, id):
+        self.get(id)
+        del self.objects[id]
+        return {'id': id, 'object': 'customer', 'deleted': True}
+
+    def create_token(self, params):
+        card = dict(self.card(params.get('card') or {}), id=self.new_id('card'), object='card')
+        return self.add({'id': self.new_id('tok'), 'object': 'token', 'type': 'card', 'card': card})
+
+    def create_payment_method(self, params):
+        return self.add({
+            'id': self.new_id('pm'),
+            'object': 'payment_method',
+            'type': params.get('type', 'card'),
+            'card': self.card(params.get('card') or {}),
+            'billing_details': params.get('billing_details') or {},
+            'customer': None
+        })
+
+    def modify_payment_method(self, params, id):
+        payment_method = self.get(id)
+        for key in ('exp_month', 'exp_year'):
+            if key in (params.get('card') or {}):
+                payment_method['card'][key] = int(params['card'][key])
+        return payment_method
+
+    def attach_payment_method(self, params, id):
+        payment_method = self.get(id)
+        self.get(params.get('customer'))
+        payment_method['customer'] = params.get('customer')
+        return payment_method
+
+    def detach_payment_method(self, params, id):
+        payment_method = self.get(id)
+        payment_method['customer'] = None
+        return payment_method
+
+    def retrieve_product(self, params, id):
+        if id not in self.objects:
+            self.add({'id': id, 'object': 'product', 'name': 'Annual plan', 'description': 'Annual plan', 'images': []})
+        return self.get(id)
+
+    def retrieve_price(self, params, id):
+        if id not in self.objects:
+            product = self.retrieve_product({}, self.new_id('prod'))
+            self.add({
+                'id': id,
+                'object': 'price',
+                'product': product['id'],
+                'unit_amount': 9900,
+                'currency': 'usd',
+                'billing_scheme': 'per_unit',
+                'recurring': {'interval': 'year', 'interval_count': 1, 'trial_period_days': self.trial_days}
+            })
+        return self.expand(self.get(id), params)
+
+    def create_subscription(self, params):
+        self.get(params.get('customer'))
+        now = int(time.time())
+        trial_end = params.get('trial_end')
+        trialing = trial_end not in (None, 'now')
+        period_end = int(trial_end) if trialing else now + 365 * 24 * 3600
+        subscription_id = self.new_id('sub')
+        invoice = self.add({
+            'id': self.new_id('in'),
+            'object': 'invoice',
+            'customer': params.get('customer'),
+            'subscription': subscription_id,
+            'lines': {'object': 'list', 'data': [{'period': {'start': now, 'end': period_end}}]}
+        })
+        return self.add({
+            'id': subscription_id,
+            'object': 'subscription',
+            'customer': params.get('customer'),
+            'status': 'trialing' if trialing else 'active',
+            'items': {'object': 'list', 'data': [{'price': {'id': item.get('price')}} for item in params.get('items') or []]},
+            'default_payment_method': params.get('default_payment_method'),
+            'current_period_start': now,
+            'current_period_end': period_end,
+            'cancel_at_period_end': False,
+            'latest_invoice': invoice['id']
+        })
+
+    def list_subscriptions(self, params):
+        return self.list_objects('subscription', params)
+
+    def create_payment_intent(self, params):
+        return self.add({
+            'id': self.new_id('pi'),
+            'object': 'payment_intent',
+            'customer': params.get('customer'),
+            'amount': int(params.get('amount') or 0),
+            'currency': params.get('currency'),
+            'payment_method': params.get('payment_method'),
+            'receipt_email': params.get('receipt_email'),
+            'status': 'requires_confirmation'
+        })
+
+    def confirm_payment_intent(self, params, id):
+        payment_intent = self.get(id)
+        payment_intent['status'] = 'succeeded'
+        return payment_intent
@@ -0,0 +1,57 @@
+import uuid
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from stripe.error import APIConnectionError, RateLimitError
+
+# Persisted idempotency keys for stripe creates. Every attempt at one logical
+# operation (the same operation and scope) sends the same key until it
+# completes, so retries after a timeout, a crash or a double submit get the
+# first result back instead of creating a second customer or charge.
+
+
+def get_idempotency_key(operation, scope):
+    from .models import StripeIdempotencyKey
+    pending = StripeIdempotencyKey.objects.filter(operation=operation, scope=scope, completed_at__isnull=True)
+    key = pending.first()
+    if key is not None:
+        return key
+    try:
+        with transaction.atomic():
+            return StripeIdempotencyKey.objects.create(operation=operation, scope=scope,
+                                                       key='%s:%s:%s' % (operation, scope, uuid.uuid4().hex))
+    except IntegrityError:
+        # a concurrent attempt created it first
+        return pending.get()
+
+
+def is_retryable(error):
+    # stripe replays the stored response of a key, 5xx included, retrying only
+    # helps when there is none: the request did not reach stripe, was rate
+    # limited or conflicted with a concurrent request on the same key.
+    if isinstance(error, (APIConnectionError, RateLimitError)):
+        return True
+    return getattr(error, 'http_status', None) in (409, 429)
+
+
+def complete_key(key, result_id='', error=''):
+    from .models import StripeIdempotencyKey
+    StripeIdempotencyKey.objects.filter(pk=key.pk).update(result_id=result_id or '', last_error=error,
+                                                          completed_at=timezone.now(), updated_at=timezone.now())
+
+
+def run_idempotent(operation, scope, create):
+    # create(key) makes the stripe call with key.key as its idempotency key
+    key = get_idempotency_key(operation, scope)
+    try:
+        result = create(key)
+    except Exception as e:
+        if is_retryable(e):
+            from .models import StripeIdempotencyKey
+            StripeIdempotencyKey.objects.filter(pk=key.pk).update(last_error=str(e), updated_at=timezone.now())
+        else:
+            # a declined card, invalid request or stripe error would be replayed, start over next time
+            complete_key(key, error=str(e))
+        raise
+    complete_key(key, result.id)
+    return result
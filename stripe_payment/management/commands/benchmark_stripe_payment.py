@@ -0,0 +1,46 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from stripe_payment.benchmark import benchmark_suite
+from stripe_payment.fakestripe import FakeStripe
+
+
+class Command(BaseCommand):
+    help = 'Time the payment api and middleware against a local fake stripe, on a throwaway test database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=100, help='Requests per endpoint.')
+        parser.add_argument('--concurrency', type=int, default=1, help='Threads sending requests.')
+        parser.add_argument('--latency', type=float, default=50, help='Milliseconds added to every stripe call.')
+        parser.add_argument('--jitter', type=float, default=0, help='Random +/- milliseconds on the latency.')
+        parser.add_argument('--error-rate', type=float, default=0, help='Share of stripe calls answered with a 500.')
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--only', nargs='*', default=None, help='Run the benchmarks whose name contains one of these.')
+        parser.add_argument('--json', default=None, help='Also write the results to this file.')
+
+    def handle(self, *args, **options):
+        old_name = connection.settings_dict['NAME']
+        setup_test_environment()
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        fake = FakeStripe(latency=options['latency'] / 1000.0,
+                          jitter=options['jitter'] / 1000.0,
+                          error_rate=options['error_rate'],
+                          seed=options['seed'])
+        try:
+            with fake:
+                results = benchmark_suite(options['iterations'], options['concurrency'], options['only'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        self.stdout.write('%-34s %7s %7s %9s %9s %9s %9s' % ('endpoint', 'count', 'errors', 'p50 ms', 'p95 ms',
+                                                           'p99 ms', 'req/s'))
+        for result in results:
+            self.stdout.write('%-34s %7d %7d %9.1f %9.1f %9.1f %9.1f' % result)
+        self.stdout.write('%s stripe calls served by the fake.' % fake.requests)
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump([result._asdict() for result in results], f, indent=2)
@@ -0,0 +1,29 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from stripe_payment.provisioning import bulk_provision_customers
+from stripe_payment.reconcile import Checkpoint
+
+
+class Command(BaseCommand):
+    help = 'Create stripe customers and stripe payment rows for users imported without save().'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since-pk', type=int, default=None, help='Only users with a greater pk.')
+        parser.add_argument('--workers', type=int, default=None, help='Concurrent stripe customer creations.')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Users created per bulk_create.')
+        parser.add_argument('--progress', default=None, help='File used to resume an interrupted run.')
+
+    def handle(self, *args, **options):
+        users = get_user_model().objects.all()
+        if options['since_pk'] is not None:
+            users = users.filter(pk__gt=options['since_pk'])
+        stats = bulk_provision_customers(users,
+                                         workers=options['workers'],
+                                         chunk_size=options['chunk_size'],
+                                         checkpoint=Checkpoint(options['progress']))
+        for user_id, error in stats['errors']:
+            self.stdout.write(self.style.ERROR('User %s: %s' % (user_id, error)))
+        self.stdout.write(self.style.SUCCESS('Created %s stripe customers, %s failed.' % (stats['created'], stats['failed'])))
+        if stats['failed']:
+            self.stdout.write('Failed users were left pending, run provision_stripe_customers to retry them.')
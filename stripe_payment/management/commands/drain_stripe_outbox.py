@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from stripe_payment.outbox import drain_outbox
+
+
+class Command(BaseCommand):
+    help = 'Deliver pending stripe side effects recorded in the outbox.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--workers', type=int, default=None)
+        parser.add_argument('--loop', action='store_true', help='Keep polling the outbox.')
+        parser.add_argument('--interval', type=float, default=2.0, help='Seconds between polls with --loop.')
+
+    def handle(self, *args, **options):
+        while True:
+            processed, failed = drain_outbox(batch_size=options['batch_size'], workers=options['workers'])
+            if processed or failed or not options['loop']:
+                self.stdout.write('Processed %s, failed %s outbox entries.' % (processed, failed))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
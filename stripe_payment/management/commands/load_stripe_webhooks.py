@@ -0,0 +1,73 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from stripe_payment.webhookload import (Sender, build_events, deliveries, load_events, run_load, save_events)
+
+
+class Command(BaseCommand):
+    help = 'Deliver signed renewal webhooks to stripe_webhooks and check the resulting stripe payment rows.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--customers', type=int, default=100)
+        parser.add_argument('--renewals', type=int, default=1, help='Renewal cycles per customer.')
+        parser.add_argument('--rate', type=float, default=0, help='Events per second, 0 for as fast as possible.')
+        parser.add_argument('--concurrency', type=int, default=8, help='Threads delivering events.')
+        parser.add_argument('--duplicates', type=float, default=0, help='Share of events delivered twice.')
+        parser.add_argument('--disorder', type=float, default=0, help='Share of events delivered out of order.')
+        parser.add_argument('--window', type=int, default=10, help='How far an event may move when out of order.')
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--workers', type=int, default=None, help='Threads processing stored events.')
+        parser.add_argument('--save', default=None, help='Write the delivery sequence to this file (JSON lines).')
+        parser.add_argument('--replay', default=None, help='Deliver the events of a saved file, in its order.')
+        parser.add_argument('--url', default=None,
+                            help='Post to a running server instead of in-process. Skips the database check.')
+
+    def handle(self, *args, **options):
+        if options['replay']:
+            delivered = load_events(options['replay'])
+            events = delivered
+        else:
+            customers = [('cus_load_%s' % n, 'sub_load_%s' % n) for n in range(options['customers'])]
+            events = build_events(customers, options['renewals'])
+            delivered = deliveries(events, options['duplicates'], options['disorder'], options['window'],
+                                   options['seed'])
+        if options['save']:
+            save_events(options['save'], delivered)
+        if not delivered:
+            raise CommandError('No events to deliver.')
+
+        if options['url']:
+            report = run_load(events, delivered, Sender(options['url']), options['rate'], options['concurrency'],
+                              check=False)
+        else:
+            if connection.vendor == 'sqlite' and (options['concurrency'] > 1 or options['workers'] != 1):
+                self.stdout.write(self.style.WARNING('sqlite locks whole tables, concurrent runs will report lock '
+                                                     'errors. Use --concurrency 1 --workers 1 or PostgreSQL.'))
+            old_name = connection.settings_dict['NAME']
+            setup_test_environment()
+            connection.creation.create_test_db(verbosity=0, autoclobber=True)
+            try:
+                report = run_load(events, delivered, Sender(), options['rate'], options['concurrency'],
+                                  options['workers'])
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+                teardown_test_environment()
+
+        delivery = report['delivery']
+        self.stdout.write('Delivered %s events in %.1fs: %.1f req/s, p50 %.1f ms, p95 %.1f ms, p99 %.1f ms' % (
+            delivery['sent'], delivery['elapsed'], delivery['rps'], delivery['p50'], delivery['p95'], delivery['p99']))
+        self.stdout.write('Responses: %s' % ', '.join('%s x%s' % (code, count)
+                                                      for code, count in sorted(delivery['statuses'].items(),
+                                                                                key=lambda item: str(item[0]))))
+        if 'processing' in report:
+            processing = report['processing']
+            self.stdout.write('Processed %s events in %.1fs, %s failed, %s still pending' % (
+                processing['processed'], processing['elapsed'], processing['failed'], processing['pending']))
+        if 'mismatches' in report:
+            mismatches = report['mismatches']
+            style = self.style.ERROR if mismatches else self.style.SUCCESS
+            self.stdout.write(style('%s of %s customers match the expected state.' % (
+                report['customers'] - len(mismatches), report['customers'])))
+            for customer_id, expected, actual in mismatches[:10]:
+                self.stdout.write('  %s expected %s, got %s' % (customer_id, expected, actual))
@@ -0,0 +1,32 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from stripe_payment.webhooks import process_events
+
+
+class Command(BaseCommand):
+    help = 'Process stored stripe webhook events, in order per customer.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--workers', type=int, default=None)
+        parser.add_argument('--worker-index', type=int, default=0,
+                            help='Index of this process when running several, it owns shards where shard %% count == index.')
+        parser.add_argument('--worker-count', type=int, default=1)
+        parser.add_argument('--loop', action='store_true', help='Keep polling for new events.')
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds between polls with --loop.')
+
+    def handle(self, *args, **options):
+        shards = None
+        if options['worker_count'] > 1:
+            shard_count = getattr(settings, 'STRIPE_WEBHOOK_SHARDS', 16)
+            shards = [shard for shard in range(shard_count) if shard % options['worker_count'] == options['worker_index']]
+        while True:
+            processed, failed = process_events(batch_size=options['batch_size'], workers=options['workers'], shards=shards)
+            if processed or failed or not options['loop']:
+                self.stdout.write('Processed %s, failed %s webhook events.' % (processed, failed))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
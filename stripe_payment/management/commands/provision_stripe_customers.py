@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from stripe_payment.provisioning import provision_pending_customers
+
+
+class Command(BaseCommand):
+    help = 'Create stripe customers for stripe payment rows still pending provisioning.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=None)
+
+    def handle(self, *args, **options):
+        count = provision_pending_customers(limit=options['limit'])
+        self.stdout.write(self.style.SUCCESS('Provisioned %s stripe customers.' % count))
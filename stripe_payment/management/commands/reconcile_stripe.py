@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from stripe_payment.reconcile import Checkpoint, reconcile
+
+
+class Command(BaseCommand):
+    help = 'Re-sync stripe payment rows with the subscriptions and customers in stripe.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--customers', action='store_true', help='Also link stripe customers to pending rows.')
+        parser.add_argument('--since', type=int, default=0, help='Unix timestamp, only objects created after it.')
+        parser.add_argument('--until', type=int, default=None, help='Unix timestamp, only objects created before it.')
+        parser.add_argument('--windows', type=int, default=1, help='Created ranges fetched in parallel.')
+        parser.add_argument('--page-size', type=int, default=100)
+        parser.add_argument('--checkpoint', default=None, help='File used to resume an interrupted run, with the --since, --until and --windows of the first run.')
+        parser.add_argument('--dry-run', action='store_true', help='Report the changes without writing them.')
+
+    def handle(self, *args, **options):
+        checkpoint = Checkpoint(options['checkpoint'])
+        kinds = ['customers', 'subscriptions'] if options['customers'] else ['subscriptions']
+        for kind in kinds:
+            stats = reconcile(kind,
+                              since=options['since'],
+                              until=options['until'],
+                              windows=options['windows'],
+                              checkpoint=checkpoint,
+                              dry_run=options['dry_run'],
+                              page_size=options['page_size'])
+            self.stdout.write('%s: seen %s, changed %s, missing locally %s, skipped for newer webhooks %s%s' % (
+                kind, stats['seen'], stats['changed'], stats['missing'], stats['skipped'],
+                ' (dry run)' if options['dry_run'] else ''))
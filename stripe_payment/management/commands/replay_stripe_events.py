@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from stripe_payment.eventlog import backfill_event_log, replay
+
+
+class Command(BaseCommand):
+    help = 'Rebuild stripe payment and payment method state from the stripe event log.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--customer', default=None, help='Only replay the events of this stripe customer.')
+        parser.add_argument('--backfill', action='store_true',
+                            help='First log processed webhook events stored before the log existed.')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Events fetched per query.')
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows written per bulk update.')
+        parser.add_argument('--dry-run', action='store_true', help='Report the changes without writing them.')
+
+    def handle(self, *args, **options):
+        if options['backfill']:
+            self.stdout.write('Logged %s stored webhook events.' % backfill_event_log())
+        stats = replay(customer_id=options['customer'],
+                       dry_run=options['dry_run'],
+                       chunk_size=options['chunk_size'],
+                       batch_size=options['batch_size'])
+        self.stdout.write('events %s, customers %s, changed %s, cards changed %s, events of customers missing '
+                          'locally %s, deleted %s, older than the log %s, charges without period end %s%s' % (
+                              stats['events'], stats['customers'], stats['changed'], stats['cards_changed'],
+                              stats['missing'], stats['deleted'], stats['incomplete'], stats['charges_unresolved'],
+                              ' (dry run)' if options['dry_run'] else ''))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from stripe_payment.sweeper import expired_subscriptions, sweep_expired_subscriptions
+
+
+class Command(BaseCommand):
+    help = 'Mark active subscriptions whose paid_until has passed as inactive.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=None)
+        parser.add_argument('--grace', type=int, default=None, help='Seconds past paid_until before a row is swept.')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the expired subscriptions.')
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            count = expired_subscriptions(grace=options['grace']).count()
+            self.stdout.write('%s expired subscriptions would be swept.' % count)
+            return
+        count = sweep_expired_subscriptions(grace=options['grace'], chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS('Swept %s expired subscriptions.' % count))
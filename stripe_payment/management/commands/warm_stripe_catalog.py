@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from stripe_payment.utils import warm_catalog
+
+
+class Command(BaseCommand):
+    help = 'Load stripe prices and their products into the local catalog.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('price_ids', nargs='*', help='Defaults to STRIPE_ANNUAL_PRICE_PLAN_ID.')
+
+    def handle(self, *args, **options):
+        warmed = warm_catalog(options['price_ids'] or None)
+        self.stdout.write(self.style.SUCCESS('Warmed %s prices.' % len(warmed)))
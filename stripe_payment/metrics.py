@@ -0,0 +1,180 @@
+import json
+import logging
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+# In-process metrics for stripe calls, rendered in the prometheus text format
+# by the metrics view. Each process keeps its own numbers, scrape every worker.
+
+logger = logging.getLogger('stripe_payment.stripe')
+
+DURATION_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+CALLS_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21)
+
+HELP = {
+    'stripe_payment_stripe_calls_total': ('counter', 'Stripe API calls by helper, endpoint and result.'),
+    'stripe_payment_stripe_call_duration_seconds': ('histogram', 'Stripe API call duration, retries included.'),
+    'stripe_payment_stripe_retries_total': ('counter', 'Stripe API retries by helper and endpoint.'),
+    'stripe_payment_request_stripe_calls': ('histogram', 'Stripe API calls made while serving one request.'),
+    'stripe_payment_rate_limit_wait_seconds': ('histogram', 'Time a stripe request waited for the rate limiter.'),
+    'stripe_payment_stripe_rate_limited_total': ('counter', 'Stripe API requests answered with 429.'),
+    'stripe_payment_stripe_breaker_state': ('gauge', 'Stripe circuit breaker state: 0 closed, 1 half open, 2 open.'),
+    'stripe_payment_stripe_breaker_transitions_total': ('counter', 'Stripe circuit breaker state changes.'),
+}
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format(name, labels, value):
+    if labels:
+        name += '{%s}' % ','.join('%s="%s"' % (key, str(val).replace('\\', '\\\\').replace('"', '\\"'))
+                                  for key, val in labels)
+    return '%s %s' % (name, repr(float(value)) if isinstance(value, float) else value)
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(int)
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, labels, value=1):
+        with self.lock:
+            self.counters[(name, _labels(labels))] += value
+
+    def set(self, name, labels, value):
+        with self.lock:
+            self.gauges[(name, _labels(labels))] = value
+
+    def observe(self, name, labels, value, buckets):
+        key = (name, _labels(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': buckets, 'counts': [0] * len(buckets),
+                                                    'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram['counts'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def render(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted((key, dict(value, counts=list(value['counts'])))
+                                for key, value in self.histograms.items())
+        lines = []
+        described = set()
+
+        def describe(name):
+            if name not in described and name in HELP:
+                described.add(name)
+                lines.append('# HELP %s %s' % (name, HELP[name][1]))
+                lines.append('# TYPE %s %s' % (name, HELP[name][0]))
+
+        for (name, labels), value in counters + gauges:
+            describe(name)
+            lines.append(_format(name, labels, value))
+        for (name, labels), histogram in histograms:
+            describe(name)
+            for bound, count in zip(histogram['buckets'], histogram['counts']):
+                lines.append(_format(name + '_bucket', labels + (('le', bound),), count))
+            lines.append(_format(name + '_bucket', labels + (('le', '+Inf'),), histogram['count']))
+            lines.append(_format(name + '_sum', labels, histogram['sum']))
+            lines.append(_format(name + '_count', labels, histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+_request = threading.local()
+_hook = None
+
+
+def current_request():
+    return getattr(_request, 'state', None)
+
+
+def bind_request(state):
+    # fan-out threads report their calls against the request they serve
+    _request.state = state
+
+
+def start_request():
+    state = {'endpoint': 'unresolved', 'calls': 0}
+    _request.state = state
+    return state
+
+
+def set_endpoint(request):
+    state = current_request()
+    match = getattr(request, 'resolver_match', None)
+    if state is not None and match is not None:
+        state['endpoint'] = '%s %s' % (request.method, getattr(match, 'route', None) or match.view_name)
+
+
+def finish_request(state):
+    _request.state = None
+    registry.observe('stripe_payment_request_stripe_calls', {'endpoint': state['endpoint']}, state['calls'],
+                     CALLS_BUCKETS)
+
+
+def get_hook():
+    global _hook
+    if _hook is None:
+        path = getattr(settings, 'STRIPE_CALL_HOOK', None)
+        _hook = import_string(path) if path else False
+    return _hook
+
+
+def error_code(error):
+    if error is None:
+        return 'ok'
+    return getattr(error, 'code', None) or error.__class__.__name__
+
+
+def record_stripe_call(operation, operation_class, duration, error=None, retries=0):
+    state = current_request()
+    endpoint = state['endpoint'] if state is not None else 'background'
+    if state is not None:
+        with registry.lock:
+            state['calls'] += 1
+    labels = {'operation': operation, 'endpoint': endpoint}
+    registry.inc('stripe_payment_stripe_calls_total', dict(labels, status=error_code(error)))
+    registry.observe('stripe_payment_stripe_call_duration_seconds', labels, duration, DURATION_BUCKETS)
+    if retries:
+        registry.inc('stripe_payment_stripe_retries_total', labels, retries)
+
+    hook = get_hook()
+    if hook or logger.isEnabledFor(logging.DEBUG):
+        record = {
+            'event': 'stripe_call',
+            'operation': operation,
+            'operation_class': operation_class,
+            'endpoint': endpoint,
+            'duration_ms': round(duration * 1000, 2),
+            'status': error_code(error),
+            'http_status': getattr(error, 'http_status', None),
+            'retries': retries,
+        }
+        logger.debug(json.dumps(record), extra={'stripe_call': record})
+        if hook:
+            try:
+                hook(record)
+            except Exception as e:
+                print(e)
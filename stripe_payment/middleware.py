@@ -1,56 +1,91 @@
-from rest_framework.authtoken.models import Token
-from django.utils.translation import ugettext_lazy as _
-from django.http import HttpResponse
-from rest_framework import status
-
-from .models import StripePayment
-from .utils import app_create_stripe_customer
-
-
-class PaymentMiddleware(object):
-
-    def __init__(self, get_response):
-        self.get_response = get_response
-
-    def __call__(self, request):
-        response = self.get_response(request)
-        return response
-
-    def process_view(self, request, view_func, view_args, view_kwargs):
-        if view_func.__module__ in set({'stripe_payment.api.v1.views', 'stripe_wallet.api.v1.views'}):
-            return None
-
-        header_token = request.META.get('HTTP_AUTHORIZATION', None)
-        if header_token is None:
-            return None
-        token = header_token.split()[1]
-
-        try:
-            token_obj = Token.objects.get(key=token)
-            user = token_obj.user
-            if user.is_superuser:
-                return None
-            stripe_customer = StripePayment.objects.filter(user=user).first()
-
-            if stripe_customer is None:
-                stripe_customer = app_create_stripe_customer(user)
-
-            # -1=incomplete, 0=inavtive, 1=active
-            if stripe_customer.status == '-1':
-                return HttpResponse(_('Apply for free trial.'), status=status.HTTP_403_FORBIDDEN)
-            elif stripe_customer.status == '0':
-                return HttpResponse(_('You have no subscription.'), status=status.HTTP_403_FORBIDDEN)
-            elif stripe_customer.status == '1':
-                import time
-                if round(time.time()) > int(stripe_customer.paid_until):
-                    return HttpResponse(_('Subscription expired.'), status=status.HTTP_403_FORBIDDEN)
-            else:
-                return HttpResponse(_('Invalid payment stattus.[SP-191]'), status=status.HTTP_400_BAD_REQUEST)
-
-        except Exception as e:
-            print(e)
-            import sys
-            import os
-            exc_type, exc_obj, exc_tb = sys.exc_info()
-            fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-            return HttpResponse(_(str(e) + '(' + fname + '-' + str(exc_tb.tb_lineno) + ')[SP-199]'), status=status.HTTP_400_BAD_REQUEST)
+from rest_framework.authtoken.models import Token
+from django.utils.translation import ugettext_lazy as _
+from django.http import HttpResponse
+from django.conf import settings
+from rest_framework import status
+
+from .utils import app_create_stripe_customer
+from .provisioning import create_pending_stripe_customer, schedule_stripe_customer
+from .breaker import stripe_available
+from .cache import entitlement_cache
+from .authentication import get_header_token, resolve_token, get_stripe_payment
+from .metrics import start_request, set_endpoint, finish_request
+from .claims import CLAIM_HEADER, claims_enabled, issue_claim, read_claim
+
+
+class PaymentMiddleware(object):
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        state = start_request()
+        try:
+            response = self.get_response(request)
+        finally:
+            finish_request(state)
+        claim = getattr(request, '_stripe_entitlement_claim', None)
+        if claim is not None:
+            response[CLAIM_HEADER] = claim
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        set_endpoint(request)
+        if view_func.__module__ in set({'stripe_payment.api.v1.views', 'stripe_wallet.api.v1.views'}):
+            return None
+
+        token = get_header_token(request)
+        if token is None:
+            return None
+
+        try:
+            # a valid claim decides without cache or db, see claims.py
+            entitlement = read_claim(request, token) if claims_enabled() else None
+            if entitlement is None:
+                entitlement = entitlement_cache.get(token)
+                if entitlement is None:
+                    token_obj = resolve_token(request, token)
+                    if token_obj is None:
+                        raise Token.DoesNotExist('Token matching query does not exist.')
+                    user = token_obj.user
+                    stripe_customer = None
+                    if not user.is_superuser:
+                        stripe_customer = get_stripe_payment(user)
+
+                        if getattr(settings, 'STRIPE_ASYNC_CUSTOMER_PROVISIONING', True):
+                            if stripe_customer is None:
+                                stripe_customer = create_pending_stripe_customer(user)
+                            elif not stripe_customer.customer_id:
+                                schedule_stripe_customer(stripe_customer.pk)
+                        elif stripe_customer is None:
+                            if stripe_available():
+                                stripe_customer = app_create_stripe_customer(user)
+                            else:
+                                # stripe is down, the customer is created once it is back
+                                stripe_customer = create_pending_stripe_customer(user)
+                    entitlement = entitlement_cache.set(token, user, stripe_customer)
+                if claims_enabled():
+                    request._stripe_entitlement_claim = issue_claim(token, entitlement)
+
+            if entitlement['is_superuser']:
+                return None
+
+            # -1=incomplete, 0=inavtive, 1=active
+            if entitlement['status'] == -1:
+                return HttpResponse(_('Apply for free trial.'), status=status.HTTP_403_FORBIDDEN)
+            elif entitlement['status'] == 0:
+                return HttpResponse(_('You have no subscription.'), status=status.HTTP_403_FORBIDDEN)
+            elif entitlement['status'] == 1:
+                import time
+                if round(time.time()) > (entitlement['paid_until'] or 0):
+                    return HttpResponse(_('Subscription expired.'), status=status.HTTP_403_FORBIDDEN)
+            else:
+                return HttpResponse(_('Invalid payment stattus.[SP-191]'), status=status.HTTP_400_BAD_REQUEST)
+
+        except Exception as e:
+            print(e)
+            import sys
+            import os
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+            return HttpResponse(_(str(e) + '(' + fname + '-' + str(exc_tb.tb_lineno) + ')[SP-199]'), status=status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,38 @@
+# Generated by Django 2.2.27 on 2026-10-18 07:32
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stripe_payment', '0006_stripepayment_is_cancel'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StripeOutbox',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('operation', models.CharField(choices=[('create_customer', 'create customer'), ('delete_customer', 'delete customer')], max_length=40, verbose_name='Operation')),
+                ('user_id', models.IntegerField(blank=True, null=True, verbose_name='User id')),
+                ('customer_id', models.CharField(blank=True, default='', max_length=200, verbose_name='Customer id')),
+                ('status', models.CharField(choices=[('-1', 'failed'), ('0', 'pending'), ('1', 'processed')], default='0', max_length=2)),
+                ('attempts', models.IntegerField(default=0, verbose_name='Attempts')),
+                ('available_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Available at')),
+                ('last_error', models.TextField(blank=True, default='', verbose_name='Last error')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Stripe Outbox',
+                'verbose_name_plural': 'Stripe Outbox',
+                'ordering': ['id'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='stripeoutbox',
+            index=models.Index(fields=['status', 'available_at'], name='stripe_outbox_pending_idx'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 2.2.27 on 2026-10-18 07:33
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stripe_payment', '0007_stripeoutbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StripeWebhookEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.CharField(max_length=255, unique=True, verbose_name='Event id')),
+                ('type', models.CharField(max_length=120, verbose_name='Type')),
+                ('customer_id', models.CharField(blank=True, default='', max_length=200, verbose_name='Customer id')),
+                ('shard', models.IntegerField(default=0, verbose_name='Shard')),
+                ('created', models.IntegerField(default=0, verbose_name='Stripe created')),
+                ('payload', models.TextField(verbose_name='Payload')),
+                ('status', models.CharField(choices=[('-1', 'failed'), ('0', 'pending'), ('1', 'processed')], default='0', max_length=2)),
+                ('attempts', models.IntegerField(default=0, verbose_name='Attempts')),
+                ('available_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Available at')),
+                ('last_error', models.TextField(blank=True, default='', verbose_name='Last error')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Stripe Webhook Event',
+                'verbose_name_plural': 'Stripe Webhook Events',
+                'ordering': ['created', 'id'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='stripewebhookevent',
+            index=models.Index(fields=['status', 'shard', 'available_at'], name='stripe_event_pending_idx'),
+        ),
+    ]
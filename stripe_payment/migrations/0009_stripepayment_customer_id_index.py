@@ -0,0 +1,18 @@
+# Generated by Django 2.2.27 on 2026-10-18 07:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stripe_payment', '0008_stripewebhookevent'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='stripepayment',
+            name='customer_id',
+            field=models.CharField(db_index=True, max_length=200, verbose_name='Customer id'),
+        ),
+    ]
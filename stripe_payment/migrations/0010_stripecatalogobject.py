@@ -0,0 +1,29 @@
+# Generated by Django 2.2.27 on 2026-10-18 07:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stripe_payment', '0009_stripepayment_customer_id_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StripeCatalogObject',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.CharField(max_length=200, unique=True, verbose_name='Object id')),
+                ('kind', models.CharField(choices=[('price', 'price'), ('product', 'product')], max_length=20, verbose_name='Kind')),
+                ('data', models.TextField(verbose_name='Data')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Stripe Catalog Object',
+                'verbose_name_plural': 'Stripe Catalog Objects',
+                'ordering': ['-id'],
+            },
+        ),
+    ]
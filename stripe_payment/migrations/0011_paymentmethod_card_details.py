@@ -0,0 +1,43 @@
+# Generated by Django 2.2.27 on 2026-10-18 07:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stripe_payment', '0010_stripecatalogobject'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paymentmethod',
+            name='billing_details',
+            field=models.TextField(blank=True, default='', verbose_name='Billing details'),
+        ),
+        migrations.AddField(
+            model_name='paymentmethod',
+            name='brand',
+            field=models.CharField(blank=True, default='', max_length=40, verbose_name='Brand'),
+        ),
+        migrations.AddField(
+            model_name='paymentmethod',
+            name='exp_month',
+            field=models.IntegerField(blank=True, null=True, verbose_name='Expiry month'),
+        ),
+        migrations.AddField(
+            model_name='paymentmethod',
+            name='exp_year',
+            field=models.IntegerField(blank=True, null=True, verbose_name='Expiry year'),
+        ),
+        migrations.AddField(
+            model_name='paymentmethod',
+            name='funding',
+            field=models.CharField(blank=True, default='', max_length=40, verbose_name='Funding'),
+        ),
+        migrations.AddField(
+            model_name='paymentmethod',
+            name='last4',
+            field=models.CharField(blank=True, default='', max_length=4, verbose_name='Last 4'),
+        ),
+    ]
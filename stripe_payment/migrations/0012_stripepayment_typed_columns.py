@@ -0,0 +1,67 @@
+# Generated by Django 2.2.27 on 2026-10-18 09:10
+
+from django.db import migrations, models
+
+TRIGGER = 'stripe_payment_sync_typed_columns'
+
+
+def create_sync_trigger(apps, schema_editor):
+    # On postgres a trigger keeps the shadow columns in step with every write
+    # of the old ones until 0014 swaps them in, so the backfill never has to
+    # chase rows changed behind it. Values that are not integers give NULL,
+    # or the column default, like to_int() in 0013.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    table = schema_editor.quote_name(apps.get_model('stripe_payment', 'StripePayment')._meta.db_table)
+    schema_editor.execute(r"""
+        CREATE OR REPLACE FUNCTION %(trigger)s() RETURNS trigger AS $$
+        BEGIN
+            NEW.paid_until_ts := CASE WHEN NEW.paid_until ~ '^\s*[-+]?\d{1,18}\s*$'
+                THEN trim(NEW.paid_until)::bigint END;
+            NEW.status_code := CASE WHEN NEW.status ~ '^\s*[-+]?\d{1,4}\s*$'
+                THEN trim(NEW.status)::smallint ELSE -1 END;
+            NEW.is_cancel_code := CASE WHEN NEW.is_cancel ~ '^\s*[-+]?\d{1,4}\s*$'
+                THEN trim(NEW.is_cancel)::smallint ELSE 0 END;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql""" % {'trigger': TRIGGER})
+    schema_editor.execute('CREATE TRIGGER %(trigger)s BEFORE INSERT OR UPDATE OF paid_until, status, is_cancel '
+                          'ON %(table)s FOR EACH ROW EXECUTE PROCEDURE %(trigger)s()' % {'trigger': TRIGGER,
+                                                                                         'table': table})
+
+
+def drop_sync_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    table = schema_editor.quote_name(apps.get_model('stripe_payment', 'StripePayment')._meta.db_table)
+    schema_editor.execute('DROP TRIGGER IF EXISTS %s ON %s' % (TRIGGER, table))
+    schema_editor.execute('DROP FUNCTION IF EXISTS %s()' % TRIGGER)
+
+
+class Migration(migrations.Migration):
+    # Expand step: nullable shadow columns, added without rewriting the table,
+    # and kept in sync with the old ones from here on. 0013 backfills them in
+    # batches and 0014 swaps them in.
+
+    dependencies = [
+        ('stripe_payment', '0011_paymentmethod_card_details'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stripepayment',
+            name='paid_until_ts',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='stripepayment',
+            name='status_code',
+            field=models.SmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='stripepayment',
+            name='is_cancel_code',
+            field=models.SmallIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(create_sync_trigger, drop_sync_trigger),
+    ]
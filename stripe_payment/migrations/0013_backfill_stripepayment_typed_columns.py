@@ -0,0 +1,76 @@
+# Generated by Django 2.2.27 on 2026-10-18 09:10
+
+from django.db import migrations, models, transaction
+
+BATCH_SIZE = 1000
+NOT_NULL_CHECKS = [
+    ('status_code', 'stripe_payment_status_code_notnull'),
+    ('is_cancel_code', 'stripe_payment_is_cancel_code_notnull'),
+]
+
+
+def to_int(value, default=None):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def backfill(apps, schema_editor):
+    # Keyset batches, each committed on its own, so no long running
+    # transaction holds row locks on the whole table. On postgres the batch
+    # rewrites paid_until onto itself and the 0012 trigger converts the row
+    # under its row lock, a concurrent write can not leave it stale.
+    StripePayment = apps.get_model('stripe_payment', 'StripePayment')
+    postgres = schema_editor.connection.vendor == 'postgresql'
+    last_pk = 0
+    while True:
+        batch = list(StripePayment.objects.filter(pk__gt=last_pk).order_by('pk')
+                     .only('pk', 'paid_until', 'status', 'is_cancel')[:BATCH_SIZE])
+        if not batch:
+            break
+        with transaction.atomic():
+            if postgres:
+                StripePayment.objects.filter(pk__gt=last_pk, pk__lte=batch[-1].pk).update(
+                    paid_until=models.F('paid_until'))
+            else:
+                for row in batch:
+                    row.paid_until_ts = to_int(row.paid_until)
+                    row.status_code = to_int(row.status, -1)
+                    row.is_cancel_code = to_int(row.is_cancel, 0)
+                StripePayment.objects.bulk_update(batch, ['paid_until_ts', 'status_code', 'is_cancel_code'])
+        last_pk = batch[-1].pk
+
+
+def add_not_null_checks(apps, schema_editor):
+    # NOT VALID only blocks writes for a moment, VALIDATE then scans the table
+    # without blocking them. 0014 turns the checks into NOT NULL, which
+    # postgres can then set without another scan.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    table = schema_editor.quote_name(apps.get_model('stripe_payment', 'StripePayment')._meta.db_table)
+    for column, name in NOT_NULL_CHECKS:
+        schema_editor.execute('ALTER TABLE %s ADD CONSTRAINT %s CHECK (%s IS NOT NULL) NOT VALID' % (
+            table, name, column))
+        schema_editor.execute('ALTER TABLE %s VALIDATE CONSTRAINT %s' % (table, name))
+
+
+def drop_not_null_checks(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    table = schema_editor.quote_name(apps.get_model('stripe_payment', 'StripePayment')._meta.db_table)
+    for column, name in NOT_NULL_CHECKS:
+        schema_editor.execute('ALTER TABLE %s DROP CONSTRAINT IF EXISTS %s' % (table, name))
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('stripe_payment', '0012_stripepayment_typed_columns'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+        migrations.RunPython(add_not_null_checks, drop_not_null_checks),
+    ]
@@ -0,0 +1,132 @@
+# Generated by Django 2.2.27 on 2026-10-18 09:10
+
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+TRIGGER = 'stripe_payment_sync_typed_columns'
+# 0013's validated CHECK constraints, per column once renamed
+NOT_NULL_CHECKS = {
+    'status': 'stripe_payment_status_code_notnull',
+    'is_cancel': 'stripe_payment_is_cancel_code_notnull',
+}
+# how long the swap waits for the table lock before failing, so it never
+# queues every write behind a long running transaction
+LOCK_TIMEOUT = '5s'
+
+
+def to_int(value, default=None):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def catch_up(apps, schema_editor):
+    # Runs in the transaction of the swap, which only renames and drops
+    # columns. On postgres the 0012 trigger converted every write since the
+    # expand step and 0013 the rows before it, so the lock is only held for
+    # the swap itself: nothing is left to copy. Other databases have no
+    # trigger, the rows changed since 0013 are copied here.
+    StripePayment = apps.get_model('stripe_payment', 'StripePayment')
+    table = schema_editor.quote_name(StripePayment._meta.db_table)
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute("SET LOCAL lock_timeout = '%s'" % LOCK_TIMEOUT)
+        schema_editor.execute('LOCK TABLE %s IN ACCESS EXCLUSIVE MODE' % table)
+        schema_editor.execute('DROP TRIGGER IF EXISTS %s ON %s' % (TRIGGER, table))
+        schema_editor.execute('DROP FUNCTION IF EXISTS %s()' % TRIGGER)
+        return
+    last_pk = 0
+    while True:
+        batch = list(StripePayment.objects.filter(pk__gt=last_pk).order_by('pk')
+                     .only('pk', 'paid_until', 'status', 'is_cancel', 'paid_until_ts', 'status_code', 'is_cancel_code')
+                     [:BATCH_SIZE])
+        if not batch:
+            break
+        stale = []
+        for row in batch:
+            values = (to_int(row.paid_until), to_int(row.status, -1), to_int(row.is_cancel, 0))
+            if values != (row.paid_until_ts, row.status_code, row.is_cancel_code):
+                row.paid_until_ts, row.status_code, row.is_cancel_code = values
+                stale.append(row)
+        StripePayment.objects.bulk_update(stale, ['paid_until_ts', 'status_code', 'is_cancel_code'])
+        last_pk = batch[-1].pk
+
+
+class AlterFieldNotNull(migrations.AlterField):
+    # On postgres SET NOT NULL finds the validated CHECK constraint of 0013
+    # and skips the table scan (postgres 12 and later), the constraint is
+    # then dropped. AlterField would fill NULLs with the default first, an
+    # UPDATE of the whole table under the swap's lock. Other databases take
+    # the usual AlterField.
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return super().database_forwards(app_label, schema_editor, from_state, to_state)
+        model = to_state.apps.get_model(app_label, self.model_name)
+        table = schema_editor.quote_name(model._meta.db_table)
+        column = schema_editor.quote_name(model._meta.get_field(self.name).column)
+        schema_editor.execute('ALTER TABLE %s ALTER COLUMN %s SET NOT NULL' % (table, column))
+        schema_editor.execute('ALTER TABLE %s DROP CONSTRAINT IF EXISTS %s' % (table, NOT_NULL_CHECKS[self.name]))
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return super().database_backwards(app_label, schema_editor, from_state, to_state)
+        model = from_state.apps.get_model(app_label, self.model_name)
+        schema_editor.execute('ALTER TABLE %s ALTER COLUMN %s DROP NOT NULL' % (
+            schema_editor.quote_name(model._meta.db_table),
+            schema_editor.quote_name(model._meta.get_field(self.name).column)))
+
+
+class Migration(migrations.Migration):
+    # Contract step: swap the backfilled columns in, in one short
+    # transaction. The indexes are built afterwards, without one.
+
+    dependencies = [
+        ('stripe_payment', '0013_backfill_stripepayment_typed_columns'),
+    ]
+
+    operations = [
+        migrations.RunPython(catch_up, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='stripepayment',
+            name='paid_until',
+        ),
+        migrations.RemoveField(
+            model_name='stripepayment',
+            name='status',
+        ),
+        migrations.RemoveField(
+            model_name='stripepayment',
+            name='is_cancel',
+        ),
+        migrations.RenameField(
+            model_name='stripepayment',
+            old_name='paid_until_ts',
+            new_name='paid_until',
+        ),
+        migrations.RenameField(
+            model_name='stripepayment',
+            old_name='status_code',
+            new_name='status',
+        ),
+        migrations.RenameField(
+            model_name='stripepayment',
+            old_name='is_cancel_code',
+            new_name='is_cancel',
+        ),
+        migrations.AlterField(
+            model_name='stripepayment',
+            name='paid_until',
+            field=models.BigIntegerField(blank=True, null=True, verbose_name='Paid until'),
+        ),
+        AlterFieldNotNull(
+            model_name='stripepayment',
+            name='status',
+            field=models.SmallIntegerField(choices=[(-1, 'incomplete'), (0, 'inactive'), (1, 'active')], default=-1),
+        ),
+        AlterFieldNotNull(
+            model_name='stripepayment',
+            name='is_cancel',
+            field=models.SmallIntegerField(choices=[(0, 'no'), (1, 'yes')], default=0),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 2.2.27 on 2026-10-18 09:10
+
+from django.db import migrations, models
+
+INDEXES = [
+    ('StripePayment', models.Index(fields=['subscription_id'], name='stripe_payment_sub_idx')),
+    ('StripePayment', models.Index(fields=['status', 'paid_until'], name='stripe_payment_expiry_idx')),
+    ('PaymentMethod', models.Index(fields=['customer', 'fingerprint'], name='payment_method_fingerprint_idx')),
+    ('PaymentMethod', models.Index(fields=['customer', 'payment_method_id'], name='payment_method_pm_idx')),
+]
+
+
+def create_indexes(apps, schema_editor):
+    # CREATE INDEX CONCURRENTLY on postgres so writes are not blocked while
+    # the indexes build.
+    for model_name, index in INDEXES:
+        model = apps.get_model('stripe_payment', model_name)
+        if schema_editor.connection.vendor != 'postgresql':
+            schema_editor.add_index(model, index)
+            continue
+        columns = ', '.join(schema_editor.quote_name(model._meta.get_field(field).column) for field in index.fields)
+        schema_editor.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS %s ON %s (%s)' % (
+            schema_editor.quote_name(index.name), schema_editor.quote_name(model._meta.db_table), columns))
+
+
+def drop_indexes(apps, schema_editor):
+    for model_name, index in INDEXES:
+        model = apps.get_model('stripe_payment', model_name)
+        if schema_editor.connection.vendor != 'postgresql':
+            schema_editor.remove_index(model, index)
+            continue
+        schema_editor.execute('DROP INDEX CONCURRENTLY IF EXISTS %s' % schema_editor.quote_name(index.name))
+
+
+class Migration(migrations.Migration):
+    # CONCURRENTLY cannot run inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ('stripe_payment', '0014_swap_stripepayment_typed_columns'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(create_indexes, drop_indexes),
+            ],
+            state_operations=[
+                migrations.AddIndex(model_name=model_name.lower(), index=index) for model_name, index in INDEXES
+            ],
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.27 on 2026-10-18 09:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stripe_payment', '0015_stripepayment_billing_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RequestProfile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('method', models.CharField(max_length=10, verbose_name='Method')),
+                ('path', models.CharField(max_length=255, verbose_name='Path')),
+                ('endpoint', models.CharField(blank=True, default='', max_length=255, verbose_name='Endpoint')),
+                ('status_code', models.IntegerField(blank=True, null=True, verbose_name='Status code')),
+                ('user_id', models.IntegerField(blank=True, null=True, verbose_name='User id')),
+                ('duration_ms', models.FloatField(default=0, verbose_name='Duration (ms)')),
+                ('db_count', models.IntegerField(default=0, verbose_name='DB queries')),
+                ('db_ms', models.FloatField(default=0, verbose_name='DB time (ms)')),
+                ('stripe_count', models.IntegerField(default=0, verbose_name='Stripe calls')),
+                ('stripe_ms', models.FloatField(default=0, verbose_name='Stripe time (ms)')),
+                ('spans', models.TextField(blank=True, default='', verbose_name='Spans')),
+                ('cprofile', models.TextField(blank=True, default='', verbose_name='cProfile')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Request Profile',
+                'verbose_name_plural': 'Request Profiles',
+                'ordering': ['-id'],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.27 on 2026-10-18 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stripe_payment', '0016_requestprofile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stripepayment',
+            name='last_event_at',
+            field=models.BigIntegerField(blank=True, null=True, verbose_name='Last event at'),
+        ),
+    ]
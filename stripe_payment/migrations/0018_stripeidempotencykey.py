@@ -0,0 +1,36 @@
+# Generated by Django 2.2.27 on 2026-10-18 10:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stripe_payment', '0017_stripepayment_last_event_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StripeIdempotencyKey',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('operation', models.CharField(max_length=40, verbose_name='Operation')),
+                ('scope', models.CharField(max_length=255, verbose_name='Scope')),
+                ('key', models.CharField(max_length=255, unique=True, verbose_name='Key')),
+                ('result_id', models.CharField(blank=True, default='', max_length=255, verbose_name='Result id')),
+                ('last_error', models.TextField(blank=True, default='', verbose_name='Last error')),
+                ('completed_at', models.DateTimeField(blank=True, null=True, verbose_name='Completed at')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Stripe Idempotency Key',
+                'verbose_name_plural': 'Stripe Idempotency Keys',
+                'ordering': ['-id'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='stripeidempotencykey',
+            constraint=models.UniqueConstraint(fields=('operation', 'scope'), condition=models.Q(completed_at__isnull=True), name='stripe_idempotency_pending_uniq'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 2.2.27 on 2026-10-18 11:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stripe_payment', '0018_stripeidempotencykey'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StripeEventLog',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.CharField(max_length=255, unique=True, verbose_name='Event id')),
+                ('type', models.CharField(max_length=120, verbose_name='Type')),
+                ('customer_id', models.CharField(blank=True, default='', max_length=200, verbose_name='Customer id')),
+                ('partition', models.IntegerField(verbose_name='Partition')),
+                ('created', models.IntegerField(default=0, verbose_name='Stripe created')),
+                ('data', models.BinaryField(verbose_name='Data')),
+                ('logged_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Stripe Event Log',
+                'verbose_name_plural': 'Stripe Event Log',
+                'ordering': ['partition', 'created', 'id'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='stripeeventlog',
+            index=models.Index(fields=['partition', 'created'], name='stripe_event_log_order_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='stripeeventlog',
+            index=models.Index(fields=['customer_id', 'created'], name='stripe_event_log_customer_idx'),
+        ),
+    ]
@@ -1,105 +1,333 @@
-from django.utils.translation import ugettext_lazy as _
-
-from django.db import models
-from stripe_payment.utils import *
-from stripe.error import StripeError
-
-from django.contrib.auth.models import User
-from django.contrib.auth import get_user_model
-User = get_user_model()
-
-
-class PaymentMethod(models.Model):
-    user = models.ForeignKey('users.User', on_delete=models.CASCADE, related_name='payment_method')
-    customer = models.ForeignKey('stripe_payment.StripePayment', on_delete=models.SET_NULL,
-                                 null=True, blank=True, related_name='payment_method')
-
-    token_id = models.CharField(_('Token ID'), max_length=255, unique=True, blank=True, null=True)
-    payment_method_id = models.CharField(_('Payment method id'), max_length=120, blank=True, null=True)
-    fingerprint = models.CharField(_('Fingerprint'), max_length=120, blank=True, null=True)
-
-    DEFAULT_CHOICES = (
-        ('0', 'no'),
-        ('1', 'yes')
-    )
-    STATUS_CHOICES = (
-        ('0', 'inactive'),
-        ('1', 'active')
-    )
-    is_default = models.CharField(max_length=2, choices=DEFAULT_CHOICES, default=0)
-    status = models.CharField(max_length=2, choices=STATUS_CHOICES, default=1)
-
-    created_at = models.DateTimeField(auto_now_add=True)
-    updated_at = models.DateTimeField(auto_now=True)
-
-    def __str__(self):
-        return str(self.payment_method_id)
-
-    class Meta:
-        verbose_name = _('Payment Method')
-        verbose_name_plural = _('Payment Methods')
-        ordering = ['-id']
-
-    def api_details(self):
-        try:
-            from django.conf import settings
-            pricing_plan = retrieve_pricing_plan(settings.STRIPE_ANNUAL_PRICE_PLAN_ID)
-            product = retrieve_stripe_product(pricing_plan.product)
-            payment_method = retrieve_payment_method(self.payment_method_id)
-            subscription_id = self.customer.subscription_id
-            return {
-                'payment_method': payment_method,
-                'product': {
-                    'product_id': product.id,
-                    'product_name': product.name,
-                    'product_description': product.description,
-                    'product_image': product.images,
-                    'product_price_id': pricing_plan.id,
-                    'currency': pricing_plan.currency,
-                    'amount': int(pricing_plan.unit_amount/100),
-                    'billing_scheme': pricing_plan.billing_scheme,
-                    'recurring': pricing_plan.recurring,
-                },
-                'subscription': {
-                    'subscription_id': subscription_id,
-                    'is_cancel': self.customer.is_cancel
-                }
-            }
-        except StripeError as e:
-            print(_(e.user_message + '[SP-175]'))
-        except Exception as e:
-            print(e + '[SP-176]')
-
-
-class StripePayment(models.Model):
-    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='stripe_payment')
-
-    customer_id = models.CharField(_('Customer id'), max_length=200)
-    payment_method_id = models.CharField(_('Payment Method id'), max_length=200, null=True, blank=True)
-    subscription_id = models.CharField(_('Subscription id'), max_length=200, null=True, blank=True)
-
-    paid_until = models.CharField( _("Paid until"), max_length=200, null=True, blank=True)
-    no_of_subscriptions = models.IntegerField(_("No of subscription"), default=0)
-
-    STATUS_CHOICES = (
-        ('-1', 'incomplete'),
-        ('0', 'inactive'),
-        ('1', 'active')
-    )
-    CANCEL = (
-        ('0', 'no'),
-        ('1', 'yes')
-    )
-    status = models.CharField(max_length=2, choices=STATUS_CHOICES, default='-1')
-    is_cancel = models.CharField(max_length=2, choices=CANCEL, default='0')
-
-    created_at = models.DateTimeField(auto_now_add=True)
-    updated_at = models.DateTimeField(auto_now=True)
-
-    def __str__(self):
-        return str(self.customer_id)
-
-    class Meta:
-        verbose_name = _('Stripe Payment')
-        verbose_name_plural = _('Stripe Payments')
-        ordering = ['-id']
+import json
+
+from django.utils.translation import ugettext_lazy as _
+
+from django.db import models
+from django.utils import timezone
+from stripe_payment.utils import *
+from stripe_payment.breaker import is_outage
+from stripe.error import StripeError
+
+from django.contrib.auth.models import User
+from django.contrib.auth import get_user_model
+User = get_user_model()
+
+
+class PaymentMethod(models.Model):
+    user = models.ForeignKey('users.User', on_delete=models.CASCADE, related_name='payment_method')
+    customer = models.ForeignKey('stripe_payment.StripePayment', on_delete=models.SET_NULL,
+                                 null=True, blank=True, related_name='payment_method')
+
+    token_id = models.CharField(_('Token ID'), max_length=255, unique=True, blank=True, null=True)
+    payment_method_id = models.CharField(_('Payment method id'), max_length=120, blank=True, null=True)
+    fingerprint = models.CharField(_('Fingerprint'), max_length=120, blank=True, null=True)
+
+    # local mirror of the stripe card, kept in sync by the payment_method webhooks
+    brand = models.CharField(_('Brand'), max_length=40, blank=True, default='')
+    last4 = models.CharField(_('Last 4'), max_length=4, blank=True, default='')
+    exp_month = models.IntegerField(_('Expiry month'), null=True, blank=True)
+    exp_year = models.IntegerField(_('Expiry year'), null=True, blank=True)
+    funding = models.CharField(_('Funding'), max_length=40, blank=True, default='')
+    billing_details = models.TextField(_('Billing details'), blank=True, default='')
+
+    DEFAULT_CHOICES = (
+        ('0', 'no'),
+        ('1', 'yes')
+    )
+    STATUS_CHOICES = (
+        ('0', 'inactive'),
+        ('1', 'active')
+    )
+    is_default = models.CharField(max_length=2, choices=DEFAULT_CHOICES, default=0)
+    status = models.CharField(max_length=2, choices=STATUS_CHOICES, default=1)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return str(self.payment_method_id)
+
+    class Meta:
+        verbose_name = _('Payment Method')
+        verbose_name_plural = _('Payment Methods')
+        ordering = ['-id']
+        indexes = [
+            models.Index(fields=['customer', 'fingerprint'], name='payment_method_fingerprint_idx'),
+            models.Index(fields=['customer', 'payment_method_id'], name='payment_method_pm_idx'),
+        ]
+
+    def card_details(self):
+        return {
+            'id': self.payment_method_id,
+            'object': 'payment_method',
+            'type': 'card',
+            'billing_details': json.loads(self.billing_details or '{}'),
+            'card': {
+                'brand': self.brand,
+                'last4': self.last4,
+                'exp_month': self.exp_month,
+                'exp_year': self.exp_year,
+                'funding': self.funding,
+                'fingerprint': self.fingerprint
+            }
+        }
+
+    def apply_card_details(self, payment_method):
+        fields = payment_method_details(payment_method)
+        PaymentMethod.objects.filter(pk=self.pk).update(**fields)
+        for field, value in fields.items():
+            setattr(self, field, value)
+
+    def refresh_card_details(self):
+        payment_method = retrieve_payment_method(self.payment_method_id)
+        self.apply_card_details(payment_method)
+        return payment_method
+
+    def api_details(self, live=False):
+        try:
+            from django.conf import settings
+            pricing_plan = get_pricing_plan(settings.STRIPE_ANNUAL_PRICE_PLAN_ID)
+            product = get_stripe_product(pricing_plan.product)
+            if live or not self.last4:
+                try:
+                    payment_method = self.refresh_card_details()
+                except StripeError as e:
+                    # stripe is down or slow, the stored card is better than no card
+                    if not self.last4 or not is_outage(e):
+                        raise
+                    payment_method = self.card_details()
+            else:
+                payment_method = self.card_details()
+            subscription_id = self.customer.subscription_id
+            return {
+                'payment_method': payment_method,
+                'product': {
+                    'product_id': product.id,
+                    'product_name': product.name,
+                    'product_description': product.description,
+                    'product_image': product.images,
+                    'product_price_id': pricing_plan.id,
+                    'currency': pricing_plan.currency,
+                    'amount': int(pricing_plan.unit_amount/100),
+                    'billing_scheme': pricing_plan.billing_scheme,
+                    'recurring': pricing_plan.recurring,
+                },
+                'subscription': {
+                    'subscription_id': subscription_id,
+                    'is_cancel': self.customer.is_cancel
+                }
+            }
+        except StripeError as e:
+            print(_(e.user_message + '[SP-175]'))
+        except Exception as e:
+            print(str(e) + '[SP-176]')
+
+
+class StripePayment(models.Model):
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='stripe_payment')
+
+    customer_id = models.CharField(_('Customer id'), max_length=200, db_index=True)
+    payment_method_id = models.CharField(_('Payment Method id'), max_length=200, null=True, blank=True)
+    subscription_id = models.CharField(_('Subscription id'), max_length=200, null=True, blank=True)
+
+    # unix timestamp
+    paid_until = models.BigIntegerField(_("Paid until"), null=True, blank=True)
+    no_of_subscriptions = models.IntegerField(_("No of subscription"), default=0)
+    # stripe `created` of the last subscription event applied, older ones are dropped
+    last_event_at = models.BigIntegerField(_("Last event at"), null=True, blank=True)
+
+    STATUS_CHOICES = (
+        (-1, 'incomplete'),
+        (0, 'inactive'),
+        (1, 'active')
+    )
+    CANCEL = (
+        (0, 'no'),
+        (1, 'yes')
+    )
+    status = models.SmallIntegerField(choices=STATUS_CHOICES, default=-1)
+    is_cancel = models.SmallIntegerField(choices=CANCEL, default=0)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return str(self.customer_id)
+
+    class Meta:
+        verbose_name = _('Stripe Payment')
+        verbose_name_plural = _('Stripe Payments')
+        ordering = ['-id']
+        indexes = [
+            models.Index(fields=['subscription_id'], name='stripe_payment_sub_idx'),
+            models.Index(fields=['status', 'paid_until'], name='stripe_payment_expiry_idx'),
+        ]
+
+
+class StripeOutbox(models.Model):
+    CREATE_CUSTOMER = 'create_customer'
+    DELETE_CUSTOMER = 'delete_customer'
+    OPERATION_CHOICES = (
+        (CREATE_CUSTOMER, 'create customer'),
+        (DELETE_CUSTOMER, 'delete customer')
+    )
+    operation = models.CharField(_('Operation'), max_length=40, choices=OPERATION_CHOICES)
+    user_id = models.IntegerField(_('User id'), null=True, blank=True)
+    customer_id = models.CharField(_('Customer id'), max_length=200, blank=True, default='')
+
+    STATUS_CHOICES = (
+        ('-1', 'failed'),
+        ('0', 'pending'),
+        ('1', 'processed')
+    )
+    status = models.CharField(max_length=2, choices=STATUS_CHOICES, default='0')
+    attempts = models.IntegerField(_('Attempts'), default=0)
+    available_at = models.DateTimeField(_('Available at'), default=timezone.now)
+    last_error = models.TextField(_('Last error'), blank=True, default='')
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return '%s %s' % (self.operation, self.customer_id or self.user_id)
+
+    class Meta:
+        verbose_name = _('Stripe Outbox')
+        verbose_name_plural = _('Stripe Outbox')
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['status', 'available_at'], name='stripe_outbox_pending_idx'),
+        ]
+
+
+class StripeWebhookEvent(models.Model):
+    event_id = models.CharField(_('Event id'), max_length=255, unique=True)
+    type = models.CharField(_('Type'), max_length=120)
+    customer_id = models.CharField(_('Customer id'), max_length=200, blank=True, default='')
+    shard = models.IntegerField(_('Shard'), default=0)
+    created = models.IntegerField(_('Stripe created'), default=0)
+    payload = models.TextField(_('Payload'))
+
+    STATUS_CHOICES = (
+        ('-1', 'failed'),
+        ('0', 'pending'),
+        ('1', 'processed')
+    )
+    status = models.CharField(max_length=2, choices=STATUS_CHOICES, default='0')
+    attempts = models.IntegerField(_('Attempts'), default=0)
+    available_at = models.DateTimeField(_('Available at'), default=timezone.now)
+    last_error = models.TextField(_('Last error'), blank=True, default='')
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return str(self.event_id)
+
+    class Meta:
+        verbose_name = _('Stripe Webhook Event')
+        verbose_name_plural = _('Stripe Webhook Events')
+        ordering = ['created', 'id']
+        indexes = [
+            models.Index(fields=['status', 'shard', 'available_at'], name='stripe_event_pending_idx'),
+        ]
+
+
+class StripeCatalogObject(models.Model):
+    KIND_CHOICES = (
+        ('price', 'price'),
+        ('product', 'product')
+    )
+    object_id = models.CharField(_('Object id'), max_length=200, unique=True)
+    kind = models.CharField(_('Kind'), max_length=20, choices=KIND_CHOICES)
+    data = models.TextField(_('Data'))
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return str(self.object_id)
+
+    class Meta:
+        verbose_name = _('Stripe Catalog Object')
+        verbose_name_plural = _('Stripe Catalog Objects')
+        ordering = ['-id']
+
+
+class StripeIdempotencyKey(models.Model):
+    operation = models.CharField(_('Operation'), max_length=40)
+    # what the operation acts on, e.g. user:12 or customer:cus_x:price_x
+    scope = models.CharField(_('Scope'), max_length=255)
+    key = models.CharField(_('Key'), max_length=255, unique=True)
+    result_id = models.CharField(_('Result id'), max_length=255, blank=True, default='')
+    last_error = models.TextField(_('Last error'), blank=True, default='')
+    completed_at = models.DateTimeField(_('Completed at'), null=True, blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return str(self.key)
+
+    class Meta:
+        verbose_name = _('Stripe Idempotency Key')
+        verbose_name_plural = _('Stripe Idempotency Keys')
+        ordering = ['-id']
+        constraints = [
+            models.UniqueConstraint(fields=['operation', 'scope'], condition=models.Q(completed_at__isnull=True),
+                                    name='stripe_idempotency_pending_uniq'),
+        ]
+
+
+class RequestProfile(models.Model):
+    method = models.CharField(_('Method'), max_length=10)
+    path = models.CharField(_('Path'), max_length=255)
+    endpoint = models.CharField(_('Endpoint'), max_length=255, blank=True, default='')
+    status_code = models.IntegerField(_('Status code'), null=True, blank=True)
+    user_id = models.IntegerField(_('User id'), null=True, blank=True)
+
+    duration_ms = models.FloatField(_('Duration (ms)'), default=0)
+    db_count = models.IntegerField(_('DB queries'), default=0)
+    db_ms = models.FloatField(_('DB time (ms)'), default=0)
+    stripe_count = models.IntegerField(_('Stripe calls'), default=0)
+    stripe_ms = models.FloatField(_('Stripe time (ms)'), default=0)
+    # json list of {kind, name, start_ms, duration_ms, error}
+    spans = models.TextField(_('Spans'), blank=True, default='')
+    cprofile = models.TextField(_('cProfile'), blank=True, default='')
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return '%s %s' % (self.method, self.path)
+
+    class Meta:
+        verbose_name = _('Request Profile')
+        verbose_name_plural = _('Request Profiles')
+        ordering = ['-id']
+
+
+class StripeEventLog(models.Model):
+    # Append-only history of processed webhook events, see eventlog.py. Rows
+    # are only ever inserted; partition is the YYYYMM of the stripe created
+    # time so a month can be scanned, archived or dropped on its own.
+    event_id = models.CharField(_('Event id'), max_length=255, unique=True)
+    type = models.CharField(_('Type'), max_length=120)
+    customer_id = models.CharField(_('Customer id'), max_length=200, blank=True, default='')
+    partition = models.IntegerField(_('Partition'))
+    created = models.IntegerField(_('Stripe created'), default=0)
+    # zlib compressed event json
+    data = models.BinaryField(_('Data'))
+
+    logged_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return str(self.event_id)
+
+    class Meta:
+        verbose_name = _('Stripe Event Log')
+        verbose_name_plural = _('Stripe Event Log')
+        ordering = ['partition', 'created', 'id']
+        indexes = [
+            models.Index(fields=['partition', 'created'], name='stripe_event_log_order_idx'),
+            models.Index(fields=['customer_id', 'created'], name='stripe_event_log_customer_idx'),
+        ]
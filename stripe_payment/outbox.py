@@ -0,0 +1,93 @@
+import datetime
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from stripe.error import InvalidRequestError
+
+from .breaker import stripe_available
+from .models import StripeOutbox, StripePayment
+from .provisioning import provision_stripe_customer
+from .utils import stripe_customer_delete
+
+
+def enqueue(operation, user_id=None, customer_id=''):
+    # Call inside the transaction that writes the user so the side effect is
+    # only recorded when the user write commits.
+    return StripeOutbox.objects.create(operation=operation, user_id=user_id, customer_id=customer_id or '')
+
+
+def retry_delay(attempts):
+    base = getattr(settings, 'STRIPE_OUTBOX_BACKOFF', 5)
+    delay = min(base * 2 ** attempts, 3600)
+    return datetime.timedelta(seconds=random.uniform(delay / 2, delay))
+
+
+def claim_batch(batch_size):
+    lease = datetime.timedelta(seconds=getattr(settings, 'STRIPE_OUTBOX_LEASE', 300))
+    now = timezone.now()
+    with transaction.atomic():
+        entries = list(
+            StripeOutbox.objects.select_for_update(skip_locked=True)
+            .filter(status='0', available_at__lte=now)
+            .order_by('id')[:batch_size]
+        )
+        # Lease the rows instead of holding the lock during stripe calls. A
+        # worker that dies leaves them to be picked up again after the lease.
+        StripeOutbox.objects.filter(pk__in=[entry.pk for entry in entries]).update(available_at=now + lease)
+    return entries
+
+
+def process_entry(entry):
+    if entry.operation == StripeOutbox.CREATE_CUSTOMER:
+        stripe_customer = StripePayment.objects.select_related('user').filter(user_id=entry.user_id).first()
+        if stripe_customer is not None:
+            provision_stripe_customer(stripe_customer)
+    elif entry.operation == StripeOutbox.DELETE_CUSTOMER:
+        try:
+            stripe_customer_delete(customer_id=entry.customer_id, user_id=entry.user_id)
+        except InvalidRequestError as e:
+            if e.code != 'resource_missing':
+                raise
+
+
+def _deliver(entry):
+    max_attempts = getattr(settings, 'STRIPE_OUTBOX_MAX_ATTEMPTS', 8)
+    try:
+        process_entry(entry)
+        StripeOutbox.objects.filter(pk=entry.pk).update(status='1', attempts=entry.attempts + 1,
+                                                        last_error='', updated_at=timezone.now())
+        return True
+    except Exception as e:
+        attempts = entry.attempts + 1
+        StripeOutbox.objects.filter(pk=entry.pk).update(status='-1' if attempts >= max_attempts else '0',
+                                                        attempts=attempts,
+                                                        available_at=timezone.now() + retry_delay(attempts),
+                                                        last_error=str(e),
+                                                        updated_at=timezone.now())
+        return False
+    finally:
+        connection.close()
+
+
+def drain_outbox(batch_size=None, workers=None, max_batches=None):
+    batch_size = batch_size or getattr(settings, 'STRIPE_OUTBOX_BATCH_SIZE', 100)
+    workers = workers or getattr(settings, 'STRIPE_OUTBOX_WORKERS', 4)
+    processed = failed = batches = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='stripe-outbox') as executor:
+        while max_batches is None or batches < max_batches:
+            if not stripe_available():
+                # every entry needs stripe, leave them to a later run
+                break
+            entries = claim_batch(batch_size)
+            if not entries:
+                break
+            batches += 1
+            for delivered in executor.map(_deliver, entries):
+                if delivered:
+                    processed += 1
+                else:
+                    failed += 1
+    return processed, failed
@@ -0,0 +1,143 @@
+import contextlib
+import cProfile
+import io
+import json
+import pstats
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+
+# Opt-in sampling profiler. Add stripe_payment.profiling.ProfilingMiddleware
+# first in MIDDLEWARE; sampled requests keep a RequestProfile with a span per
+# DB query and stripe call, and optionally a cProfile dump.
+
+_profile = threading.local()
+# only one cProfile can run per process at a time
+_cprofile_lock = threading.Lock()
+
+
+def current_profile():
+    return getattr(_profile, 'profile', None)
+
+
+def bind_profile(profile):
+    _profile.profile = profile
+
+
+class Profile(object):
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def add_span(self, kind, name, start, duration, error=None):
+        with self.lock:
+            self.spans.append({
+                'kind': kind,
+                'name': name,
+                'start_ms': round((start - self.start) * 1000, 2),
+                'duration_ms': round(duration * 1000, 2),
+                'error': error,
+            })
+
+    def totals(self, kind):
+        spans = [span for span in self.spans if span['kind'] == kind]
+        return len(spans), round(sum(span['duration_ms'] for span in spans), 2)
+
+
+def add_span(kind, name, start, duration, error=None):
+    profile = current_profile()
+    if profile is not None:
+        profile.add_span(kind, name, start, duration, error)
+
+
+def _query_span(execute, sql, params, many, context):
+    start = time.perf_counter()
+    error = None
+    try:
+        return execute(sql, params, many, context)
+    except Exception as e:
+        error = str(e)
+        raise
+    finally:
+        add_span('db', sql[:500], start, time.perf_counter() - start, error)
+
+
+def should_profile(request):
+    token = getattr(settings, 'STRIPE_PROFILE_TOKEN', None)
+    if token and request.META.get('HTTP_X_STRIPE_PROFILE') == token:
+        return True
+    return random.random() < getattr(settings, 'STRIPE_PROFILE_SAMPLE_RATE', 0)
+
+
+def render_cprofile(profiler, limit=60):
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(limit)
+    return out.getvalue()
+
+
+def save_profile(request, response, profile, duration, cprofile_text=''):
+    from .models import RequestProfile
+    match = getattr(request, 'resolver_match', None)
+    user = getattr(request, 'user', None)
+    db_count, db_ms = profile.totals('db')
+    stripe_count, stripe_ms = profile.totals('stripe')
+    RequestProfile.objects.create(method=request.method,
+                                  path=request.path[:255],
+                                  endpoint=(getattr(match, 'route', None) or getattr(match, 'view_name', None) or '')[:255],
+                                  status_code=getattr(response, 'status_code', None),
+                                  user_id=user.pk if user is not None and user.is_authenticated else None,
+                                  duration_ms=round(duration * 1000, 2),
+                                  db_count=db_count,
+                                  db_ms=db_ms,
+                                  stripe_count=stripe_count,
+                                  stripe_ms=stripe_ms,
+                                  spans=json.dumps(profile.spans),
+                                  cprofile=cprofile_text)
+    keep = getattr(settings, 'STRIPE_PROFILE_KEEP', 200)
+    cutoff = RequestProfile.objects.order_by('-id').values_list('id', flat=True)[keep:keep + 1]
+    if cutoff:
+        RequestProfile.objects.filter(id__lte=cutoff[0]).delete()
+
+
+class ProfilingMiddleware(object):
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not should_profile(request):
+            return self.get_response(request)
+
+        profile = Profile()
+        bind_profile(profile)
+        profiler = None
+        if getattr(settings, 'STRIPE_PROFILE_CPROFILE', False) and _cprofile_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+        response = None
+        try:
+            with contextlib.ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(_query_span))
+                if profiler is not None:
+                    profiler.enable()
+                try:
+                    response = self.get_response(request)
+                finally:
+                    if profiler is not None:
+                        profiler.disable()
+            duration = time.perf_counter() - profile.start
+        finally:
+            bind_profile(None)
+            if profiler is not None:
+                _cprofile_lock.release()
+
+        try:
+            save_profile(request, response, profile, duration, render_cprofile(profiler) if profiler else '')
+        except Exception as e:
+            print(e)
+        return response
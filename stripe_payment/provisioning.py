@@ -0,0 +1,209 @@
+import datetime
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection, transaction
+from stripe.error import StripeError
+
+from .breaker import stripe_available
+from .models import StripePayment, StripeOutbox
+from .ratelimit import get_bucket, stripe_priority, TokenBucket, BACKGROUND
+from .reconcile import Checkpoint
+from .utils import create_stripe_customer, stripe_customer_delete
+
+_executor = None
+_executor_lock = threading.Lock()
+_inflight = set()
+_inflight_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'STRIPE_PROVISIONING_WORKERS', 4),
+                thread_name_prefix='stripe-provisioning'
+            )
+        return _executor
+
+
+def create_pending_stripe_customer(user):
+    # customer_id='' marks a row whose stripe customer is not created yet
+    stripe_customer, created = StripePayment.objects.get_or_create(
+        user_id=user.id,
+        defaults={
+            'customer_id': '',
+            'paid_until': round(datetime.datetime.now().timestamp()),
+            'status': -1  # -1=incomplete, 0=inavtive, 1=active
+        }
+    )
+    if not stripe_customer.customer_id:
+        transaction.on_commit(lambda: schedule_stripe_customer(stripe_customer.pk))
+    return stripe_customer
+
+
+def provision_stripe_customer(stripe_customer):
+    if stripe_customer.customer_id:
+        return stripe_customer
+    customer = create_stripe_customer(stripe_customer.user)
+    updated = StripePayment.objects.filter(pk=stripe_customer.pk, customer_id='').update(customer_id=customer.id)
+    if not updated:
+        # another worker provisioned this user first. With the shared
+        # idempotency key it usually got the same customer, else drop ours.
+        stripe_customer.refresh_from_db()
+        if stripe_customer.customer_id != customer.id:
+            stripe_customer_delete(customer.id)
+        return stripe_customer
+    stripe_customer.customer_id = customer.id
+    return stripe_customer
+
+
+def _provision(stripe_customer_id):
+    try:
+        stripe_customer = StripePayment.objects.select_related('user').filter(pk=stripe_customer_id).first()
+        if stripe_customer is not None:
+            provision_stripe_customer(stripe_customer)
+    except StripeError as e:
+        print(e.user_message)
+    except Exception as e:
+        print(e)
+    finally:
+        with _inflight_lock:
+            _inflight.discard(stripe_customer_id)
+        connection.close()
+
+
+def _submit(stripe_customer_id):
+    with _inflight_lock:
+        if stripe_customer_id in _inflight:
+            return None
+        _inflight.add(stripe_customer_id)
+    return get_executor().submit(_provision, stripe_customer_id)
+
+
+def defer_stripe_customer(stripe_customer_id):
+    # The outbox retries with backoff until stripe is back, the pool would
+    # only fail fast and leave the row pending until the next request.
+    from .outbox import enqueue
+    user_id = StripePayment.objects.filter(pk=stripe_customer_id).values_list('user_id', flat=True).first()
+    if user_id is None or StripeOutbox.objects.filter(operation=StripeOutbox.CREATE_CUSTOMER, user_id=user_id,
+                                                      status='0').exists():
+        return False
+    enqueue(StripeOutbox.CREATE_CUSTOMER, user_id=user_id)
+    return True
+
+
+def schedule_stripe_customer(stripe_customer_id):
+    if not stripe_available():
+        return defer_stripe_customer(stripe_customer_id)
+    return _submit(stripe_customer_id) is not None
+
+
+def provision_pending_customers(limit=None):
+    pending = StripePayment.objects.filter(customer_id='').order_by('pk').values_list('pk', flat=True)
+    if limit:
+        pending = pending[:limit]
+    futures = [future for future in map(_submit, list(pending)) if future is not None]
+    for future in futures:
+        future.result()
+    return len(futures)
+
+
+def get_bulk_bucket():
+    # The shared bucket keeps the import behind checkout's calls. Without
+    # one configured the import still gets a bucket of its own, it must not
+    # send all its workers at stripe unthrottled.
+    if get_bucket() is not None:
+        return None
+    return TokenBucket(getattr(settings, 'STRIPE_BULK_PROVISIONING_RATE', 25), reserve=0)
+
+
+def _bulk_create_customer(user, bucket):
+    try:
+        with stripe_priority(BACKGROUND):
+            if bucket is not None:
+                bucket.acquire(BACKGROUND)
+            return user.id, create_stripe_customer(user).id, None
+    except StripeError as e:
+        return user.id, '', e.user_message or str(e)
+    except Exception as e:
+        return user.id, '', str(e)
+
+
+def _close_worker_connections(executor, workers):
+    # One task per worker thread closes its database connection once the run
+    # is over; the barrier keeps a thread from taking two of them.
+    barrier = threading.Barrier(workers)
+
+    def close():
+        barrier.wait()
+        connection.close()
+
+    for future in [executor.submit(close) for index in range(workers)]:
+        future.result()
+
+
+def bulk_provision_chunk(users, executor, bucket=None):
+    # users have no stripe customer yet; rows are created or filled in once
+    # the whole chunk is back from stripe. Returns the stats and the
+    # (user_id, error) of every failed creation.
+    stats = Counter()
+    results = list(executor.map(lambda user: _bulk_create_customer(user, bucket), users))
+    customer_ids = {user_id: customer_id for user_id, customer_id, error in results if customer_id}
+    errors = [(user_id, error) for user_id, customer_id, error in results if error]
+    stats['created'] = len(customer_ids)
+    stats['failed'] = len(results) - len(customer_ids)
+
+    pending = {row.user_id: row for row in StripePayment.objects.filter(user_id__in=[user.id for user in users])}
+    paid_until = round(datetime.datetime.now().timestamp())
+    with transaction.atomic():
+        # failed users get a pending row too, provision_stripe_customers picks them up
+        StripePayment.objects.bulk_create([
+            StripePayment(user_id=user.id,
+                          customer_id=customer_ids.get(user.id, ''),
+                          paid_until=paid_until,
+                          status=-1)  # -1=incomplete, 0=inavtive, 1=active
+            for user in users if user.id not in pending
+        ], ignore_conflicts=True)
+        for user_id, row in pending.items():
+            if customer_ids.get(user_id):
+                StripePayment.objects.filter(pk=row.pk, customer_id='').update(customer_id=customer_ids[user_id])
+    return stats, errors
+
+
+def bulk_provision_customers(users, workers=None, chunk_size=500, checkpoint=None):
+    # Stripe customers for a user import done with bulk_create, which skips
+    # stripe_customer_post_save. Users are walked in pk order; the last pk of
+    # every finished chunk goes to the checkpoint so an interrupted run resumes
+    # after it, and the idempotency keys make a retried chunk reuse the
+    # customers stripe already created for it. Calls are background ones in
+    # the STRIPE_RATE_LIMIT bucket, or limited to STRIPE_BULK_PROVISIONING_RATE
+    # when there is none. stats['errors'] lists the (user_id, error) of the
+    # creations that failed in this run.
+    workers = workers or getattr(settings, 'STRIPE_BULK_PROVISIONING_WORKERS', 16)
+    checkpoint = checkpoint or Checkpoint()
+    state = checkpoint.get('bulk_provision')
+    stats = Counter({key: state.get(key, 0) for key in ('created', 'failed')})
+    errors = []
+    last_pk = state.get('last_pk')
+    users = users.filter(is_superuser=False).exclude(stripe_payment__customer_id__gt='').order_by('pk')
+    bucket = get_bulk_bucket()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='stripe-bulk-provisioning') as executor:
+        try:
+            while True:
+                chunk = users.filter(pk__gt=last_pk) if last_pk is not None else users
+                chunk = list(chunk[:chunk_size])
+                if not chunk:
+                    break
+                chunk_stats, chunk_errors = bulk_provision_chunk(chunk, executor, bucket)
+                stats.update(chunk_stats)
+                errors.extend(chunk_errors)
+                last_pk = chunk[-1].pk
+                checkpoint.update('bulk_provision', last_pk=last_pk, created=stats['created'], failed=stats['failed'])
+        finally:
+            _close_worker_connections(executor, workers)
+    stats['errors'] = errors
+    return stats
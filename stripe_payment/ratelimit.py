@@ -0,0 +1,198 @@
+import contextlib
+import fcntl
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .metrics import current_request, registry, DURATION_BUCKETS
+
+# Client side token bucket every stripe request passes through, one attempt at
+# a time. Calls made while serving a request are interactive, everything else
+# (commands, workers, the provisioning pool) is background unless wrapped in
+# stripe_priority(). Background calls leave the reserve share of the bucket to
+# interactive ones and pause after a 429, so they back off first.
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+_priority = threading.local()
+
+
+def current_priority():
+    priority = getattr(_priority, 'priority', None)
+    if priority is not None:
+        return priority
+    return INTERACTIVE if current_request() is not None else BACKGROUND
+
+
+def bind_priority(priority):
+    _priority.priority = priority
+
+
+@contextlib.contextmanager
+def stripe_priority(priority):
+    previous = getattr(_priority, 'priority', None)
+    _priority.priority = priority
+    try:
+        yield
+    finally:
+        _priority.priority = previous
+
+
+class LocalBackend(object):
+    # One bucket per process.
+
+    def __init__(self):
+        self.state = {}
+        self.lock = threading.Lock()
+
+    def update(self, func):
+        with self.lock:
+            self.state, result = func(dict(self.state))
+            return result
+
+
+class FileBackend(object):
+    # One bucket per host, the state file is locked with flock while updated.
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def update(self, func):
+        with self.lock, open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                content = f.read()
+                state, result = func(json.loads(content) if content else {})
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            return result
+
+
+class CacheBackend(object):
+    # One bucket per cache, shared by every host using it. Django caches have
+    # no compare and set, updates hold a lock taken with cache.add.
+    key = 'stripe_payment:ratelimit'
+
+    def __init__(self, alias='default', lock_timeout=5):
+        self.alias = alias
+        self.lock_timeout = lock_timeout
+
+    def update(self, func):
+        cache = caches[self.alias]
+        while not cache.add(self.key + ':lock', 1, self.lock_timeout):
+            time.sleep(0.001)
+        try:
+            state, result = func(cache.get(self.key) or {})
+            cache.set(self.key, state, None)
+            return result
+        finally:
+            cache.delete(self.key + ':lock')
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst=None, reserve=0.25, backend=None, penalty=1):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.reserve = self.burst * reserve
+        self.backend = backend or LocalBackend()
+        self.penalty = penalty
+
+    def _refill(self, state, now):
+        tokens = min(self.burst, state.get('tokens', self.burst) + (now - state.get('updated', now)) * self.rate)
+        return dict(state, tokens=tokens, updated=now)
+
+    def try_acquire(self, priority):
+        # Takes a token and returns 0, or returns the seconds to wait first.
+        def take(state):
+            now = time.time()
+            state = self._refill(state, now)
+            floor = 1
+            if priority != INTERACTIVE:
+                paused = state.get('paused_until', 0) - now
+                if paused > 0:
+                    return state, paused
+                floor += self.reserve
+            # a bucket smaller than the floor never fills up to it
+            floor = min(floor, self.burst)
+            if state['tokens'] >= floor:
+                state['tokens'] -= 1
+                return state, 0
+            return state, (floor - state['tokens']) / self.rate
+        return self.backend.update(take)
+
+    def penalize(self):
+        # stripe answered 429: empty the bucket and pause background calls
+        def drain(state):
+            now = time.time()
+            return dict(state, tokens=0, updated=now, paused_until=now + self.penalty), None
+        self.backend.update(drain)
+
+    def acquire(self, priority, max_wait=None):
+        # Interactive calls give up waiting after max_wait and go ahead anyway,
+        # stripe rejecting them is no worse than keeping the user waiting.
+        start = time.monotonic()
+        waited = 0
+        while True:
+            wait = self.try_acquire(priority)
+            if not wait or (max_wait is not None and waited + wait > max_wait):
+                break
+            time.sleep(wait)
+            waited = time.monotonic() - start
+        if waited:
+            registry.observe('stripe_payment_rate_limit_wait_seconds', {'priority': priority}, waited, DURATION_BUCKETS)
+        return waited
+
+
+def build_backend():
+    backend = getattr(settings, 'STRIPE_RATE_LIMIT_BACKEND', 'local')
+    if backend == 'file':
+        return FileBackend(getattr(settings, 'STRIPE_RATE_LIMIT_FILE', '/tmp/stripe_payment_ratelimit.json'))
+    if backend == 'cache':
+        return CacheBackend(getattr(settings, 'STRIPE_RATE_LIMIT_CACHE_ALIAS', 'default'))
+    return LocalBackend()
+
+
+_bucket = None
+_bucket_lock = threading.Lock()
+
+
+def get_bucket():
+    global _bucket
+    rate = getattr(settings, 'STRIPE_RATE_LIMIT', None)
+    if not rate:
+        return None
+    with _bucket_lock:
+        if _bucket is None:
+            _bucket = TokenBucket(rate,
+                                  burst=getattr(settings, 'STRIPE_RATE_LIMIT_BURST', None),
+                                  reserve=getattr(settings, 'STRIPE_RATE_LIMIT_RESERVE', 0.25),
+                                  backend=build_backend(),
+                                  penalty=getattr(settings, 'STRIPE_RATE_LIMIT_PENALTY', 1))
+        return _bucket
+
+
+def acquire():
+    bucket = get_bucket()
+    if bucket is None:
+        return 0
+    priority = current_priority()
+    max_wait = getattr(settings, 'STRIPE_RATE_LIMIT_MAX_WAIT', 2) if priority == INTERACTIVE else None
+    return bucket.acquire(priority, max_wait)
+
+
+def rate_limited():
+    bucket = get_bucket()
+    if bucket is not None:
+        registry.inc('stripe_payment_stripe_rate_limited_total', {'priority': current_priority()})
+        bucket.penalize()
@@ -0,0 +1,193 @@
+import json
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connection
+
+from .cache import invalidate_entitlement
+from .models import StripePayment
+from .utils import list_subscriptions, list_stripe_customers
+
+ACTIVE_STATUSES = ('active', 'trialing', 'past_due')
+
+
+class Checkpoint(object):
+    # Last page cursor per created window, written after every page so an
+    # interrupted run resumes where it stopped.
+
+    def __init__(self, path=None):
+        self.path = path
+        self.state = {}
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.state = json.load(f)
+
+    def get(self, key):
+        with self.lock:
+            return dict(self.state.get(key, {}))
+
+    def update(self, key, **values):
+        with self.lock:
+            self.state.setdefault(key, {}).update(values)
+            if self.path:
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump(self.state, f)
+                os.replace(tmp_path, self.path)
+
+
+class NewestSubscriptions(object):
+    # The subscription each customer's row follows during a run, shared by
+    # the windows that page a customer's subscriptions in parallel: an active
+    # one wins over an ended one, then the newest.
+
+    def __init__(self):
+        self.ranks = {}
+        self.lock = threading.Lock()
+
+    def claim(self, subscription):
+        rank = (subscription.status in ACTIVE_STATUSES, subscription.created or 0)
+        with self.lock:
+            if rank < self.ranks.get(subscription.customer, rank):
+                return False
+            self.ranks[subscription.customer] = rank
+            return True
+
+
+def subscription_state(stripe_customer, subscription):
+    if subscription.status in ACTIVE_STATUSES:
+        return {
+            'subscription_id': subscription.id,
+            'status': 1,
+            'paid_until': subscription.current_period_end,
+            'is_cancel': 1 if subscription.cancel_at_period_end else 0
+        }
+    if stripe_customer.subscription_id == subscription.id:
+        # same end state as the customer.subscription.deleted webhook
+        return {
+            'subscription_id': '',
+            'payment_method_id': '',
+            'status': 0,
+            'paid_until': 0,
+            'is_cancel': 0
+        }
+    return {}
+
+
+def subscription_changes(stripe_customer, subscription):
+    desired = subscription_state(stripe_customer, subscription)
+    return {field: value for field, value in desired.items() if getattr(stripe_customer, field) != value}
+
+
+def reconcile_subscriptions_page(subscriptions, dry_run=False, read_at=None, newest=None):
+    # Rows are written one by one and only if no webhook newer than the page
+    # was applied meanwhile; the write stamps last_event_at with the read
+    # time so older webhooks arriving late do not undo it. An ended
+    # subscription only clears the row while it still follows it.
+    from .webhooks import is_current
+    read_at = read_at or int(time.time())
+    newest = newest or NewestSubscriptions()
+    stats = Counter(seen=len(subscriptions))
+    rows = {row.customer_id: row for row in
+            StripePayment.objects.filter(customer_id__in={subscription.customer for subscription in subscriptions})}
+    for subscription in subscriptions:
+        row = rows.get(subscription.customer)
+        if row is None:
+            stats['missing'] += 1
+            continue
+        if not newest.claim(subscription) or not subscription_changes(row, subscription):
+            continue
+        if dry_run:
+            stats['changed'] += 1
+            continue
+        current = StripePayment.objects.filter(is_current({'created': read_at}), pk=row.pk)
+        if subscription.status not in ACTIVE_STATUSES:
+            current = current.filter(subscription_id=subscription.id)
+        if current.update(last_event_at=read_at, **subscription_state(row, subscription)):
+            stats['changed'] += 1
+            invalidate_entitlement(row.user_id)
+        else:
+            stats['skipped'] += 1
+    return stats
+
+
+def reconcile_customers_page(customers, dry_run=False, read_at=None, newest=None):
+    # Picks up stripe customers whose id never made it back to a pending row.
+    stats = Counter(seen=len(customers))
+    by_user = {}
+    for customer in customers:
+        user_id = (customer.get('metadata') or {}).get('user_id')
+        if user_id and str(user_id).isdigit():
+            by_user[int(user_id)] = customer.id
+    rows = list(StripePayment.objects.filter(user_id__in=by_user, customer_id=''))
+    stats['changed'] = len(rows)
+    if not dry_run:
+        for row in rows:
+            # still pending, provisioning may have filled it in meanwhile
+            StripePayment.objects.filter(pk=row.pk, customer_id='').update(customer_id=by_user[row.user_id])
+    return stats
+
+
+RECONCILERS = {
+    'subscriptions': (list_subscriptions, reconcile_subscriptions_page, {'status': 'all'}),
+    'customers': (list_stripe_customers, reconcile_customers_page, {}),
+}
+
+
+def reconcile_window(kind, window, checkpoint, dry_run=False, page_size=100, newest=None):
+    list_objects, reconcile_page, params = RECONCILERS[kind]
+    key = '%s:%s-%s' % (kind, window[0], window[1])
+    state = checkpoint.get(key)
+    stats = Counter()
+    if state.get('done'):
+        return stats
+    starting_after = state.get('starting_after')
+    try:
+        while True:
+            page_params = dict(params, limit=page_size, created={'gte': window[0], 'lt': window[1]})
+            if starting_after:
+                page_params['starting_after'] = starting_after
+            read_at = int(time.time())
+            page = list_objects(**page_params)
+            if page.data:
+                stats.update(reconcile_page(page.data, dry_run, read_at, newest))
+            if not page.has_more or not page.data:
+                checkpoint.update(key, done=True)
+                break
+            starting_after = page.data[-1].id
+            checkpoint.update(key, starting_after=starting_after)
+    finally:
+        connection.close()
+    return stats
+
+
+def created_windows(since, until, count):
+    bounds = sorted(set(since + (until - since) * index // count for index in range(count + 1)))
+    return list(zip(bounds, bounds[1:]))
+
+
+def reconcile(kind='subscriptions', since=0, until=None, windows=1, checkpoint=None, dry_run=False, page_size=100):
+    # Memory stays flat: one page of stripe objects and their local rows per
+    # window at a time, however many objects there are, plus the rank of the
+    # subscription each seen customer follows.
+    checkpoint = checkpoint or Checkpoint()
+    # The window bounds are part of the checkpoint keys, a resumed run reuses
+    # the ones of the first run instead of a new default until.
+    run = checkpoint.get(kind)
+    if run:
+        since, until, windows = run['since'], run['until'], run['windows']
+    else:
+        until = until or int(time.time()) + 1
+        checkpoint.update(kind, since=since, until=until, windows=windows)
+    stats = Counter()
+    newest = NewestSubscriptions()
+    with ThreadPoolExecutor(max_workers=windows, thread_name_prefix='stripe-reconcile') as executor:
+        futures = [executor.submit(reconcile_window, kind, window, checkpoint, dry_run, page_size, newest)
+                   for window in created_windows(since, until, windows)]
+        for future in futures:
+            stats.update(future.result())
+    return stats
@@ -1,41 +1,65 @@
-from django.db.models.signals import post_save, post_delete
-from django.dispatch import receiver
-
-from .utils import create_stripe_customer, stripe_customer_delete
-from .models import StripePayment
-
-from stripe.error import StripeError
-from django.contrib.auth.models import User
-from django.contrib.auth import get_user_model
-User = get_user_model()
-
-
-@receiver(post_save, sender=User)
-def stripe_customer_post_save(sender, instance, created, **kwargs):
-    if created and instance.is_superuser is not True:
-        try:
-            customer = create_stripe_customer(user=instance)
-            import datetime
-            extend_time = datetime.datetime.now()
-            StripePayment.objects.create(
-                user=instance,
-                customer_id=customer.id,
-                paid_until=round(extend_time.timestamp()),
-                status='-1'  # -1=incomplete, 0=inavtive, 1=active
-            ) 
-        except StripeError as e:
-            print(e.user_message)
-        except Exception as e:
-            print(e)
-
-
-@receiver(post_delete, sender=User)
-def stripe_customer_post_delete(sender, instance, *args, **kwargs):
-    stripe_customer = StripePayment.objects.filter(user=instance)[0]
-    if stripe_customer.customer_id:
-        try:
-            stripe_customer_delete(customer_id=stripe_customer.customer_id)
-        except StripeError as e:
-            print(e.user_message)
-        except Exception as e:
-            print(e)
+from django.db import transaction
+from django.db.models.signals import post_init, post_save, post_delete, pre_delete
+from django.dispatch import receiver
+
+from .models import StripePayment, StripeOutbox
+from .outbox import enqueue
+from .cache import entitlement_cache, invalidate_entitlement
+
+from rest_framework.authtoken.models import Token
+from django.contrib.auth.models import User
+from django.contrib.auth import get_user_model
+User = get_user_model()
+
+
+@receiver(post_save, sender=User)
+def stripe_customer_post_save(sender, instance, created, **kwargs):
+    if created and instance.is_superuser is not True:
+        import datetime
+        extend_time = datetime.datetime.now()
+        with transaction.atomic():
+            StripePayment.objects.create(
+                user=instance,
+                customer_id='',
+                paid_until=round(extend_time.timestamp()),
+                status=-1  # -1=incomplete, 0=inavtive, 1=active
+            )
+            enqueue(StripeOutbox.CREATE_CUSTOMER, user_id=instance.id)
+
+
+@receiver(pre_delete, sender=User)
+def stripe_customer_pre_delete(sender, instance, *args, **kwargs):
+    # pre_delete, the stripe payment row is already gone by post_delete
+    stripe_customer = StripePayment.objects.filter(user=instance).first()
+    if stripe_customer is not None and stripe_customer.customer_id:
+        enqueue(StripeOutbox.DELETE_CUSTOMER, user_id=instance.id, customer_id=stripe_customer.customer_id)
+
+
+ENTITLEMENT_USER_FIELDS = ('is_superuser', 'is_active')
+
+
+def entitlement_user_fields(instance):
+    # __dict__, reading a deferred field would query it on every load
+    return tuple(instance.__dict__.get(field) for field in ENTITLEMENT_USER_FIELDS)
+
+
+@receiver(post_init, sender=User)
+def entitlement_user_post_init(sender, instance, **kwargs):
+    instance._entitlement_fields = entitlement_user_fields(instance)
+
+
+@receiver(post_save, sender=User)
+def entitlement_user_post_save(sender, instance, created, update_fields=None, **kwargs):
+    # Saves that leave both fields alone, like the last_login update of every
+    # login, keep the cached entitlement.
+    if update_fields is not None and not set(ENTITLEMENT_USER_FIELDS) & set(update_fields):
+        return
+    fields = entitlement_user_fields(instance)
+    if not created and fields != getattr(instance, '_entitlement_fields', None):
+        invalidate_entitlement(instance.id)
+    instance._entitlement_fields = fields
+
+
+@receiver(post_delete, sender=Token)
+def entitlement_token_post_delete(sender, instance, *args, **kwargs):
+    entitlement_cache.invalidate_token(instance.key)
@@ -0,0 +1,35 @@
+import time
+
+from django.conf import settings
+from django.db.models import Q
+
+from .cache import invalidate_entitlement
+from .models import StripePayment
+
+
+def expired_subscriptions(now=None, grace=None):
+    if now is None:
+        now = round(time.time())
+    if grace is None:
+        grace = getattr(settings, 'STRIPE_EXPIRY_GRACE', 0)
+    # Range scans on the (status, paid_until) index. A NULL paid_until, left
+    # by a legacy value the typed column could not hold, counts as expired
+    # like in the middleware.
+    return StripePayment.objects.filter(Q(paid_until__lt=now - grace) | Q(paid_until__isnull=True), status=1)
+
+
+def sweep_expired_subscriptions(now=None, grace=None, chunk_size=None):
+    if now is None:
+        now = round(time.time())
+    chunk_size = chunk_size or getattr(settings, 'STRIPE_EXPIRY_CHUNK_SIZE', 1000)
+    expired = expired_subscriptions(now, grace)
+    swept = 0
+    while True:
+        chunk = list(expired.order_by('paid_until', 'pk').values_list('pk', 'user_id')[:chunk_size])
+        if not chunk:
+            break
+        # re-check the condition so a renewal applied meanwhile is not undone
+        swept += expired.filter(pk__in=[pk for pk, user_id in chunk]).update(status=0)
+        for pk, user_id in chunk:
+            invalidate_entitlement(user_id)
+    return swept
@@ -1,3 +1,232 @@
-from django.test import TestCase
-
-# Create your tests here.
+import json
+from collections import namedtuple
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.utils import timezone
+from stripe.error import APIConnectionError, APIError, CardError, InvalidRequestError, RateLimitError
+
+from .breaker import CircuitBreaker, CircuitOpenError, CLOSED, HALF_OPEN, OPEN
+from .cache import entitlement_cache
+from .idempotency import is_retryable, run_idempotent
+from .models import StripeIdempotencyKey, StripePayment, StripeWebhookEvent
+from .ratelimit import TokenBucket, BACKGROUND, INTERACTIVE
+from .sweeper import expired_subscriptions, sweep_expired_subscriptions
+from .webhooks import coalesce_events, is_current, is_current_state
+
+User = get_user_model()
+Created = namedtuple('Created', 'id')
+
+
+def create_stripe_payment(username, **fields):
+    # the user's post_save creates the pending row
+    user = User.objects.create(username=username)
+    StripePayment.objects.filter(user=user).update(**dict({'customer_id': 'cus_' + username}, **fields))
+    return StripePayment.objects.get(user=user)
+
+
+class IdempotencyTest(TestCase):
+
+    def test_is_retryable(self):
+        self.assertTrue(is_retryable(APIConnectionError('timeout')))
+        self.assertTrue(is_retryable(RateLimitError('slow down', http_status=429)))
+        self.assertTrue(is_retryable(APIError('conflict', http_status=409)))
+        self.assertFalse(is_retryable(CardError('declined', None, 'card_declined', http_status=402)))
+        self.assertFalse(is_retryable(InvalidRequestError('bad', 'price', http_status=400)))
+        self.assertFalse(is_retryable(APIError('stripe error', http_status=500)))
+
+    def attempt(self, error=None):
+        keys = []
+
+        def create(key):
+            keys.append(key.key)
+            if error is not None:
+                raise error
+            return Created('cus_1')
+
+        try:
+            run_idempotent('create_customer', 'user:1', create)
+        except Exception as e:
+            self.assertIs(e, error)
+        return keys[0]
+
+    def test_key_reused_after_connection_error(self):
+        first = self.attempt(APIConnectionError('timeout'))
+        key = StripeIdempotencyKey.objects.get(key=first)
+        self.assertIsNone(key.completed_at)
+        self.assertEqual(key.last_error, 'timeout')
+        self.assertEqual(self.attempt(), first)
+        key.refresh_from_db()
+        self.assertIsNotNone(key.completed_at)
+        self.assertEqual(key.result_id, 'cus_1')
+
+    def test_key_completed_after_client_error(self):
+        first = self.attempt(CardError('declined', None, 'card_declined', http_status=402))
+        self.assertIsNotNone(StripeIdempotencyKey.objects.get(key=first).completed_at)
+        self.assertNotEqual(self.attempt(), first)
+
+    def test_key_completed_after_server_error(self):
+        # stripe replays a stored 500 for the same key
+        first = self.attempt(APIError('stripe error', http_status=500))
+        self.assertIsNotNone(StripeIdempotencyKey.objects.get(key=first).completed_at)
+        self.assertNotEqual(self.attempt(), first)
+
+    def test_completed_key_not_reused(self):
+        first = self.attempt()
+        self.assertNotEqual(self.attempt(), first)
+        self.assertEqual(StripeIdempotencyKey.objects.filter(completed_at__isnull=False).count(), 2)
+
+
+class WebhookOrderingTest(TestCase):
+
+    def create_event(self, event_id, type, object_id, created):
+        payload = json.dumps({'id': event_id, 'type': type, 'created': created, 'data': {'object': {'id': object_id}}})
+        return StripeWebhookEvent.objects.create(event_id=event_id, type=type, customer_id='cus_1', created=created,
+                                                 payload=payload)
+
+    def test_coalesce_events(self):
+        events = [
+            self.create_event('evt_1', 'customer.subscription.created', 'sub_1', 1),
+            self.create_event('evt_2', 'charge.succeeded', 'ch_1', 2),
+            self.create_event('evt_3', 'customer.subscription.updated', 'sub_1', 3),
+            self.create_event('evt_4', 'customer.subscription.updated', 'sub_2', 4),
+            self.create_event('evt_5', 'customer.subscription.updated', 'sub_1', 5),
+            self.create_event('evt_6', 'customer.subscription.deleted', 'sub_1', 6),
+        ]
+        kept, superseded = coalesce_events(events)
+        self.assertEqual([stored.event_id for stored in kept], ['evt_2', 'evt_4', 'evt_5', 'evt_6'])
+        self.assertEqual(superseded, {events[0].pk, events[2].pk})
+
+    def test_is_current(self):
+        create_stripe_payment('never', last_event_at=None)
+        create_stripe_payment('older', last_event_at=100)
+        create_stripe_payment('same', last_event_at=150)
+        create_stripe_payment('newer', last_event_at=200)
+        current = StripePayment.objects.filter(is_current({'created': 150}))
+        self.assertEqual(sorted(current.values_list('customer_id', flat=True)), ['cus_never', 'cus_older', 'cus_same'])
+
+    def test_is_current_state(self):
+        state = {'subscription_id': 'sub_1', 'last_event_at': 150}
+        self.assertTrue(is_current_state(state, {'id': 'sub_1'}, 150))
+        self.assertTrue(is_current_state(state, {'id': 'sub_1'}, 200))
+        self.assertFalse(is_current_state(state, {'id': 'sub_1'}, 100))
+        self.assertFalse(is_current_state(state, {'id': 'sub_2'}, 200))
+        self.assertTrue(is_current_state(dict(state, last_event_at=None), {'id': 'sub_1'}, None))
+
+
+class TokenBucketTest(TestCase):
+
+    def test_reserve_left_to_interactive(self):
+        # refills too slowly to matter during the test
+        bucket = TokenBucket(0.001, burst=4, reserve=0.5)
+        self.assertEqual(bucket.try_acquire(BACKGROUND), 0)
+        self.assertEqual(bucket.try_acquire(BACKGROUND), 0)
+        self.assertGreater(bucket.try_acquire(BACKGROUND), 0)
+        self.assertEqual(bucket.try_acquire(INTERACTIVE), 0)
+        self.assertEqual(bucket.try_acquire(INTERACTIVE), 0)
+        self.assertGreater(bucket.try_acquire(INTERACTIVE), 0)
+
+    def test_penalize_pauses_background(self):
+        bucket = TokenBucket(10, penalty=60)
+        bucket.penalize()
+        self.assertGreater(bucket.try_acquire(BACKGROUND), 59)
+        self.assertLess(bucket.try_acquire(INTERACTIVE), 1)
+
+    def test_floor_clamped_to_burst(self):
+        bucket = TokenBucket(1, reserve=0.25)
+        self.assertEqual(bucket.try_acquire(BACKGROUND), 0)
+
+
+class CircuitBreakerTest(TestCase):
+
+    def open_breaker(self):
+        breaker = CircuitBreaker(error_rate=0.5, min_calls=4, cooldown=30)
+        breaker.record(0.01, None)
+        breaker.record(0.01, APIConnectionError('timeout'))
+        breaker.record(0.01, APIError('stripe error', http_status=500))
+        self.assertEqual(breaker.state, CLOSED)
+        breaker.record(6, None)  # slow call
+        self.assertEqual(breaker.state, OPEN)
+        return breaker
+
+    def cool_down(self, breaker):
+        breaker.opened_at -= breaker.cooldown
+
+    def test_client_errors_keep_it_closed(self):
+        breaker = CircuitBreaker(error_rate=0.5, min_calls=4)
+        for index in range(10):
+            breaker.record(0.01, CardError('declined', None, 'card_declined', http_status=402))
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertFalse(breaker.allow())
+
+    def test_open_fails_fast(self):
+        breaker = self.open_breaker()
+        self.assertRaises(CircuitOpenError, breaker.allow)
+        self.assertTrue(breaker.is_open())
+
+    def test_trial_closes(self):
+        breaker = self.open_breaker()
+        self.cool_down(breaker)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, HALF_OPEN)
+        # one trial at a time
+        self.assertRaises(CircuitOpenError, breaker.allow)
+        breaker.record(0.01, None, trial=True)
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertFalse(breaker.allow())
+
+    def test_failed_trial_reopens(self):
+        breaker = self.open_breaker()
+        self.cool_down(breaker)
+        self.assertTrue(breaker.allow())
+        breaker.record(0.01, APIConnectionError('timeout'), trial=True)
+        self.assertEqual(breaker.state, OPEN)
+        self.assertRaises(CircuitOpenError, breaker.allow)
+
+
+class SweeperTest(TestCase):
+
+    def setUp(self):
+        self.expired = create_stripe_payment('expired', status=1, paid_until=900)
+        self.unknown = create_stripe_payment('unknown', status=1, paid_until=None)
+        self.in_grace = create_stripe_payment('in_grace', status=1, paid_until=990)
+        self.paid = create_stripe_payment('paid', status=1, paid_until=2000)
+        self.inactive = create_stripe_payment('inactive', status=0, paid_until=900)
+
+    def test_expired_subscriptions(self):
+        self.assertEqual(set(expired_subscriptions(now=1000, grace=0)), {self.expired, self.unknown, self.in_grace})
+        self.assertEqual(set(expired_subscriptions(now=1000, grace=50)), {self.expired, self.unknown})
+
+    def test_sweep(self):
+        self.assertEqual(sweep_expired_subscriptions(now=1000, grace=50, chunk_size=1), 2)
+        statuses = dict(StripePayment.objects.values_list('customer_id', 'status'))
+        self.assertEqual(statuses, {'cus_expired': 0, 'cus_unknown': 0, 'cus_in_grace': 1, 'cus_paid': 1,
+                                    'cus_inactive': 0})
+
+
+class EntitlementCacheTest(TestCase):
+
+    def setUp(self):
+        entitlement_cache.clear()
+        self.stripe_customer = create_stripe_payment('cached', status=1, paid_until=2000)
+        self.user = User.objects.get(pk=self.stripe_customer.user_id)
+        entitlement_cache.set('token', self.user, self.stripe_customer)
+
+    def test_login_keeps_entitlement(self):
+        self.user.last_login = timezone.now()
+        with self.assertNumQueries(1):
+            self.user.save(update_fields=['last_login'])
+        self.user.first_name = 'name'
+        self.user.save()
+        self.assertEqual(entitlement_cache.get('token')['status'], 1)
+
+    def test_superuser_change_invalidates(self):
+        self.user.is_superuser = True
+        self.user.save()
+        self.assertIsNone(entitlement_cache.get('token'))
+
+    def test_deactivation_invalidates(self):
+        user = User.objects.get(pk=self.user.pk)
+        user.is_active = False
+        user.save(update_fields=['is_active'])
+        self.assertIsNone(entitlement_cache.get('token'))
@@ -1,186 +1,516 @@
-from django.conf import settings
-import stripe
-from stripe.error import StripeError
-
-from .models import *
-
-# stripe_api_key = settings.STRIPE_LIVE_SECRET_KEY
-stripe_api_key = settings.STRIPE_TEST_SECRET_KEY
-if settings.DEBUG:
-    stripe_api_key = settings.STRIPE_TEST_SECRET_KEY
-stripe.api_key = stripe_api_key
-
-
-def create_stripe_customer(user):
-    return stripe.Customer.create(
-        name=user.name,
-        email=user.email,
-        metadata={
-            'user_id': user.id
-        }
-    )
-
-
-def app_create_stripe_customer(user):
-    stripe_customer = create_stripe_customer(user)
-    if stripe_customer:
-        import datetime
-        extend_time = datetime.datetime.now()
-        from .models import StripePayment
-        return StripePayment.objects.create(user_id=user.id,
-                                            customer_id=stripe_customer.id,
-                                            paid_until=round(extend_time.timestamp()),
-                                            status='-1')  # -1=incomplete, 0=inavtive, 1=active
-    return None
-
-
-def stripe_customer_delete(customer_id, user_id=None):
-    return stripe.Customer.delete(customer_id)
-
-
-def retrieve_stripe_customer(customer_id):
-    return stripe.Customer.retrieve(customer_id)
-
-
-def customer_default_payment_method(customer_id, payment_method_id):
-    return stripe.Customer.modify(customer_id,
-        invoice_settings={
-            'default_payment_method': payment_method_id
-        }
-    )
-
-
-def create_card_token(data):
-    return stripe.Token.create(
-        card={
-            "number": data['number'],
-            "exp_month": data['exp_month'],
-            "exp_year": data['exp_year'],
-            "cvc": data['cvc']
-        }
-    )
-
-
-def retrieve_card_token(token):
-    return stripe.Token.retrieve(token)
-
-
-def retrieve_stripe_product(product_id):
-    return stripe.Product.retrieve(product_id)
-
-
-def retrieve_pricing_plan(id):
-    return stripe.Price.retrieve(id)
-
-
-def create_payment_intent(data, email, customer_Id, payment_method_id):
-    return stripe.PaymentIntent.create(
-        customer=customer_Id,
-        amount=data.unit_amount,
-        currency=data.currency,
-        payment_method_types=["card"],
-        payment_method=payment_method_id,
-        receipt_email=email,
-        capture_method="automatic",
-    )
-    
-
-def retrieve_payment_intent(payment_intent_id):
-    return stripe.PaymentIntent.retrieve(payment_intent_id)
-
-
-def modify_payment_intent(payment_intent_id, payment_method_id, customer_id):
-    return stripe.PaymentIntent.modify(payment_intent_id, 
-        payment_mehthod_id=payment_method_id,
-        customer=customer_id
-    )
-
-
-def confirm_payment_intent(intent_id):
-    return stripe.PaymentIntent.confirm(intent_id)
-
-
-def create_payment_method(data, user):
-    return stripe.PaymentMethod.create(
-        type="card",
-        card={
-            "number": data['number'],
-            "exp_month": data['exp_month'],
-            "exp_year": data['exp_year'],
-            "cvc": data['cvc'],
-        },
-        billing_details={
-            'email': user.email,
-            'name': user.username,
-        }
-    )
-
-
-def retrieve_payment_method(payment_method_id):
-    return stripe.PaymentMethod.retrieve(payment_method_id)
-
-
-def modify_payment_method(payment_method_id, data):
-    return stripe.PaymentMethod.modify(
-        payment_method_id,
-        card={
-            "exp_month": data['exp_month'],
-            "exp_year": data['exp_year']
-        },
-    )
-
-
-def attach_payment_method(payment_method_id, customer_id):
-    return stripe.PaymentMethod.attach(payment_method_id, 
-        customer=customer_id,
-    )
-
-
-def detach_payment_method(payment_method_id):
-    return stripe.PaymentMethod.detach(payment_method_id)
-
-
-def create_trial_subscription(customer_id, price_id, trial_days):
-    if trial_days is None:
-        trial_days=7 # default 7 days
-    from django.utils.timezone import timedelta
-    import datetime
-    trial_end = datetime.datetime.now() + timedelta(days=trial_days)
-    
-    return stripe.Subscription.create(customer=customer_id,
-        items=[{
-            'price': price_id
-        }],
-        trial_end=trial_end
-    )
-
-
-def create_stripe_subscription(customer_id, payment_method_id, pricing_plan_id):
-    return stripe.Subscription.create(
-        customer=customer_id,
-        items=[{
-            'price': pricing_plan_id
-        }],
-        default_payment_method=payment_method_id,
-        trial_end='now'
-    )
-
-
-def cancel_stripe_subscription(subscription_id):
-    return stripe.Subscription.modify(subscription_id,
-        cancel_at_period_end=True
-    )
-
-
-def not_cancel_stripe_subscription(subscription_id):
-    return stripe.Subscription.modify(subscription_id,
-        cancel_at_period_end=False
-    )
-
-
-def retrieve_customer_subscription(subscription_id):
-    return stripe.Subscription.retrieve(subscription_id)
-
-
-def latest_subscription_invoice(latest_invoice_id):
-    return stripe.Invoice.retrieve(latest_invoice_id)
+from django.conf import settings
+from django.db import connections
+import functools
+import json
+import random
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import stripe
+from requests.adapters import HTTPAdapter
+from stripe.error import StripeError
+
+from .models import *
+from .cache import LRUCache
+from .metrics import bind_request, current_request, record_stripe_call
+from .profiling import add_span, bind_profile, current_profile
+from .idempotency import run_idempotent
+from .ratelimit import acquire, bind_priority, current_priority, rate_limited
+from .breaker import get_breaker
+
+# stripe_api_key = settings.STRIPE_LIVE_SECRET_KEY
+stripe_api_key = settings.STRIPE_TEST_SECRET_KEY
+if settings.DEBUG:
+    stripe_api_key = settings.STRIPE_TEST_SECRET_KEY
+stripe.api_key = stripe_api_key
+
+# Timeouts are (connect, read) seconds per operation class. Retries reuse the
+# idempotency key stripe-python sends with every POST, so writes are safe too.
+# Creates with a persisted key (see idempotency.py) can also be retried by the
+# next request, so they give up on a slow response early and try again.
+STRIPE_HTTP_TIMEOUTS = dict({
+    'read': (3, 10),
+    'write': (3, 30),
+    'idempotent': (3, 8)
+}, **getattr(settings, 'STRIPE_HTTP_TIMEOUTS', {}))
+STRIPE_HTTP_RETRIES = dict({
+    'read': 2,
+    'write': 1,
+    'idempotent': 3
+}, **getattr(settings, 'STRIPE_HTTP_RETRIES', {}))
+
+_call_options = threading.local()
+
+
+class StripeHTTPClient(stripe.http_client.RequestsClient):
+    # One pooled keep-alive session per process, shared by every thread.
+
+    def __init__(self, pool_size=None, **kwargs):
+        pool_size = pool_size or getattr(settings, 'STRIPE_HTTP_POOL_SIZE', 20)
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        super().__init__(session=session, verify_ssl_certs=stripe.verify_ssl_certs, proxy=stripe.proxy, **kwargs)
+
+    @staticmethod
+    def operation_class():
+        return getattr(_call_options, 'operation_class', None) or 'read'
+
+    @property
+    def _timeout(self):
+        return tuple(STRIPE_HTTP_TIMEOUTS[self.operation_class()])
+
+    @_timeout.setter
+    def _timeout(self, value):
+        # set by RequestsClient.__init__, timeouts come from the operation class
+        pass
+
+    def _max_network_retries(self):
+        return STRIPE_HTTP_RETRIES[self.operation_class()]
+
+    def request(self, method, url, headers, post_data=None):
+        # every attempt, retries included, takes a token of the shared limiter
+        acquire()
+        response = super().request(method, url, headers, post_data)
+        if response[1] == 429:
+            rate_limited()
+        return response
+
+    def _sleep_time_seconds(self, num_retries, response=None):
+        _call_options.retries = getattr(_call_options, 'retries', 0) + 1
+        delay = min(getattr(settings, 'STRIPE_RETRY_INITIAL_DELAY', 0.5) * 2 ** (num_retries - 1),
+                    getattr(settings, 'STRIPE_RETRY_MAX_DELAY', 4))
+        sleep_seconds = random.uniform(0, delay)
+        retry_after = self._retry_after_header(response) or 0
+        if retry_after <= self.MAX_RETRY_AFTER:
+            sleep_seconds = max(retry_after, sleep_seconds)
+        return sleep_seconds
+
+
+stripe.default_http_client = StripeHTTPClient()
+
+
+def call_stripe(operation_class, func, *args, **kwargs):
+    previous = getattr(_call_options, 'operation_class', None)
+    _call_options.operation_class = operation_class
+    retries = getattr(_call_options, 'retries', 0)
+    breaker = get_breaker() if previous is None else None
+    trial = None
+    start = time.perf_counter()
+    error = None
+    try:
+        if breaker is not None:
+            # fails fast while stripe is down, see breaker.py
+            trial = breaker.allow()
+        return func(*args, **kwargs)
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        _call_options.operation_class = previous
+        # helpers calling helpers are recorded once, by the outermost call
+        if previous is None:
+            duration = time.perf_counter() - start
+            if trial is not None:
+                breaker.record(duration, error, trial)
+            record_stripe_call(func.__name__, operation_class, duration, error,
+                               getattr(_call_options, 'retries', 0) - retries)
+            add_span('stripe', func.__name__, start, duration, error and str(error))
+
+
+def stripe_operation(operation_class):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return call_stripe(operation_class, func, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@stripe_operation('idempotent')
+def create_stripe_customer(user):
+    return run_idempotent('create_customer', 'user:%s' % user.id, lambda key: stripe.Customer.create(
+        name=user.name,
+        email=user.email,
+        metadata={
+            'user_id': user.id
+        },
+        idempotency_key=key.key
+    ))
+
+
+def app_create_stripe_customer(user):
+    stripe_customer = create_stripe_customer(user)
+    if stripe_customer:
+        import datetime
+        extend_time = datetime.datetime.now()
+        from .models import StripePayment
+        return StripePayment.objects.create(user_id=user.id,
+                                            customer_id=stripe_customer.id,
+                                            paid_until=round(extend_time.timestamp()),
+                                            status=-1)  # -1=incomplete, 0=inavtive, 1=active
+    return None
+
+
+@stripe_operation('write')
+def stripe_customer_delete(customer_id, user_id=None):
+    return stripe.Customer.delete(customer_id)
+
+
+@stripe_operation('read')
+def retrieve_stripe_customer(customer_id):
+    return stripe.Customer.retrieve(customer_id)
+
+
+@stripe_operation('write')
+def customer_default_payment_method(customer_id, payment_method_id):
+    return stripe.Customer.modify(customer_id,
+        invoice_settings={
+            'default_payment_method': payment_method_id
+        }
+    )
+
+
+@stripe_operation('write')
+def create_card_token(data):
+    return stripe.Token.create(
+        card={
+            "number": data['number'],
+            "exp_month": data['exp_month'],
+            "exp_year": data['exp_year'],
+            "cvc": data['cvc']
+        }
+    )
+
+
+@stripe_operation('read')
+def retrieve_card_token(token):
+    return stripe.Token.retrieve(token)
+
+
+@stripe_operation('read')
+def retrieve_stripe_product(product_id):
+    return stripe.Product.retrieve(product_id)
+
+
+@stripe_operation('read')
+def retrieve_pricing_plan(id, expand=None):
+    return stripe.Price.retrieve(id, expand=expand or [])
+
+
+# Prices and products barely change, they are served from memory, then from
+# the StripeCatalogObject table and only then from stripe. Webhooks keep both
+# layers fresh, STRIPE_CATALOG_TTL bounds how stale they can get otherwise.
+CATALOG_CLASSES = {
+    'price': stripe.Price,
+    'product': stripe.Product
+}
+catalog = LRUCache(maxsize=1000, ttl=getattr(settings, 'STRIPE_CATALOG_TTL', 3600))
+
+
+def store_catalog_object(data):
+    from .models import StripeCatalogObject
+    data = json.loads(json.dumps(data))
+    if data['object'] == 'price' and isinstance(data.get('product'), dict):
+        data['product'] = store_catalog_object(data['product']).id
+    obj = CATALOG_CLASSES[data['object']].construct_from(data, stripe.api_key)
+    StripeCatalogObject.objects.update_or_create(object_id=obj.id,
+                                                 defaults={'kind': data['object'], 'data': json.dumps(data)})
+    catalog.set(obj.id, obj)
+    return obj
+
+
+def delete_catalog_object(object_id):
+    from .models import StripeCatalogObject
+    StripeCatalogObject.objects.filter(object_id=object_id).delete()
+    catalog.delete(object_id)
+
+
+def get_catalog_object(kind, object_id):
+    obj = catalog.get(object_id)
+    if obj is not None:
+        return obj
+
+    from .models import StripeCatalogObject
+    from django.utils import timezone
+    row = StripeCatalogObject.objects.filter(object_id=object_id).first()
+    if row is not None:
+        obj = CATALOG_CLASSES[kind].construct_from(json.loads(row.data), stripe.api_key)
+        if (timezone.now() - row.updated_at).total_seconds() < catalog.ttl:
+            catalog.set(object_id, obj)
+            return obj
+
+    try:
+        if kind == 'price':
+            return store_catalog_object(retrieve_pricing_plan(object_id, expand=['product']))
+        return store_catalog_object(retrieve_stripe_product(object_id))
+    except StripeError:
+        # a stale catalog beats failing the request
+        if row is None:
+            raise
+        return obj
+
+
+def get_pricing_plan(price_id):
+    return get_catalog_object('price', price_id)
+
+
+def get_stripe_product(product_id):
+    return get_catalog_object('product', product_id)
+
+
+def warm_catalog(price_ids=None):
+    if price_ids is None:
+        price_ids = [settings.STRIPE_ANNUAL_PRICE_PLAN_ID]
+    warmed = []
+    for price_id in price_ids:
+        try:
+            warmed.append(store_catalog_object(retrieve_pricing_plan(price_id, expand=['product'])))
+        except StripeError as e:
+            print(e.user_message)
+        except Exception as e:
+            print(e)
+    return warmed
+
+
+@stripe_operation('idempotent')
+def create_payment_intent(data, email, customer_Id, payment_method_id):
+    scope = 'customer:%s:%s:%s' % (customer_Id, data.id, payment_method_id)
+    return run_idempotent('create_payment_intent', scope, lambda key: stripe.PaymentIntent.create(
+        customer=customer_Id,
+        amount=data.unit_amount,
+        currency=data.currency,
+        payment_method_types=["card"],
+        payment_method=payment_method_id,
+        receipt_email=email,
+        capture_method="automatic",
+        idempotency_key=key.key
+    ))
+    
+
+@stripe_operation('read')
+def retrieve_payment_intent(payment_intent_id):
+    return stripe.PaymentIntent.retrieve(payment_intent_id)
+
+
+@stripe_operation('write')
+def modify_payment_intent(payment_intent_id, payment_method_id, customer_id):
+    return stripe.PaymentIntent.modify(payment_intent_id, 
+        payment_mehthod_id=payment_method_id,
+        customer=customer_id
+    )
+
+
+@stripe_operation('write')
+def confirm_payment_intent(intent_id):
+    return stripe.PaymentIntent.confirm(intent_id)
+
+
+@stripe_operation('write')
+def create_payment_method(data, user):
+    return stripe.PaymentMethod.create(
+        type="card",
+        card={
+            "number": data['number'],
+            "exp_month": data['exp_month'],
+            "exp_year": data['exp_year'],
+            "cvc": data['cvc'],
+        },
+        billing_details={
+            'email': user.email,
+            'name': user.username,
+        }
+    )
+
+
+@stripe_operation('read')
+def retrieve_payment_method(payment_method_id):
+    return stripe.PaymentMethod.retrieve(payment_method_id)
+
+
+def payment_method_details(payment_method):
+    card = payment_method.get('card') or {}
+    return {
+        'brand': card.get('brand') or '',
+        'last4': card.get('last4') or '',
+        'exp_month': card.get('exp_month'),
+        'exp_year': card.get('exp_year'),
+        'funding': card.get('funding') or '',
+        'billing_details': json.dumps(payment_method.get('billing_details') or {})
+    }
+
+
+@stripe_operation('write')
+def modify_payment_method(payment_method_id, data):
+    return stripe.PaymentMethod.modify(
+        payment_method_id,
+        card={
+            "exp_month": data['exp_month'],
+            "exp_year": data['exp_year']
+        },
+    )
+
+
+@stripe_operation('write')
+def attach_payment_method(payment_method_id, customer_id):
+    return stripe.PaymentMethod.attach(payment_method_id, 
+        customer=customer_id,
+    )
+
+
+@stripe_operation('write')
+def detach_payment_method(payment_method_id):
+    return stripe.PaymentMethod.detach(payment_method_id)
+
+
+@stripe_operation('idempotent')
+def create_trial_subscription(customer_id, price_id, trial_days):
+    if trial_days is None:
+        trial_days=7 # default 7 days
+    from django.utils.timezone import timedelta
+
+    def create(key):
+        # the trial starts with the first attempt so a retry sends the same trial_end
+        return stripe.Subscription.create(customer=customer_id,
+            items=[{
+                'price': price_id
+            }],
+            trial_end=key.created_at + timedelta(days=trial_days),
+            idempotency_key=key.key
+        )
+    return run_idempotent('create_trial_subscription', 'customer:%s:%s' % (customer_id, price_id), create)
+
+
+@stripe_operation('idempotent')
+def create_stripe_subscription(customer_id, payment_method_id, pricing_plan_id):
+    scope = 'customer:%s:%s:%s' % (customer_id, pricing_plan_id, payment_method_id)
+    return run_idempotent('create_subscription', scope, lambda key: stripe.Subscription.create(
+        customer=customer_id,
+        items=[{
+            'price': pricing_plan_id
+        }],
+        default_payment_method=payment_method_id,
+        trial_end='now',
+        idempotency_key=key.key
+    ))
+
+
+@stripe_operation('write')
+def cancel_stripe_subscription(subscription_id):
+    return stripe.Subscription.modify(subscription_id,
+        cancel_at_period_end=True
+    )
+
+
+@stripe_operation('write')
+def not_cancel_stripe_subscription(subscription_id):
+    return stripe.Subscription.modify(subscription_id,
+        cancel_at_period_end=False
+    )
+
+
+@stripe_operation('read')
+def retrieve_customer_subscription(subscription_id):
+    return stripe.Subscription.retrieve(subscription_id)
+
+
+@stripe_operation('read')
+def list_subscriptions(**params):
+    return stripe.Subscription.list(**params)
+
+
+@stripe_operation('read')
+def list_stripe_customers(**params):
+    return stripe.Customer.list(**params)
+
+
+@stripe_operation('read')
+def latest_subscription_invoice(latest_invoice_id, expand=None):
+    return stripe.Invoice.retrieve(latest_invoice_id, expand=expand or [])
+
+
+RETRIEVERS = {
+    'customer': retrieve_stripe_customer,
+    'token': retrieve_card_token,
+    'product': retrieve_stripe_product,
+    'price': retrieve_pricing_plan,
+    'payment_intent': retrieve_payment_intent,
+    'payment_method': retrieve_payment_method,
+    'subscription': retrieve_customer_subscription,
+    'invoice': latest_subscription_invoice,
+}
+RetrieveResult = namedtuple('RetrieveResult', ['id', 'object', 'error'])
+_fanout_executor = None
+_fanout_lock = threading.Lock()
+
+
+def get_fanout_executor():
+    global _fanout_executor
+    with _fanout_lock:
+        if _fanout_executor is None:
+            _fanout_executor = ThreadPoolExecutor(max_workers=getattr(settings, 'STRIPE_FANOUT_WORKERS', 8),
+                                                  thread_name_prefix='stripe-fanout')
+        return _fanout_executor
+
+
+def _run_bound(context, func, *args):
+    # context is the (metrics, profile, priority) state of the request in a fan-out thread
+    bind_request(context[0])
+    bind_profile(context[1])
+    bind_priority(context[2])
+    try:
+        return func(*args)
+    finally:
+        bind_request(None)
+        bind_profile(None)
+        bind_priority(None)
+        # pool threads outlive requests, do not keep their db connections
+        connections.close_all()
+
+
+def _retrieve_one(retrieve, object_id):
+    try:
+        return RetrieveResult(object_id, retrieve(object_id), None)
+    except Exception as e:
+        return RetrieveResult(object_id, None, e)
+
+
+def retrieve_many(kind, ids):
+    # Fetch several stripe objects at once, the latency is the slowest call
+    # instead of the sum. Results keep the order of ids, failures are
+    # returned in RetrieveResult.error instead of raised.
+    retrieve = RETRIEVERS[kind]
+    unique_ids = list(OrderedDict.fromkeys(object_id for object_id in ids if object_id))
+    if len(unique_ids) == 1:
+        results = {unique_ids[0]: _retrieve_one(retrieve, unique_ids[0])}
+    else:
+        context = (current_request(), current_profile(), current_priority())
+        futures = {object_id: get_fanout_executor().submit(_run_bound, context, _retrieve_one, retrieve, object_id)
+                   for object_id in unique_ids}
+        results = {object_id: future.result() for object_id, future in futures.items()}
+    return [results[object_id] if object_id else RetrieveResult(object_id, None, ValueError('Missing id'))
+            for object_id in ids]
+
+
+CallResult = namedtuple('CallResult', ['object', 'error'])
+
+
+def _call_one(func):
+    try:
+        return CallResult(func(), None)
+    except Exception as e:
+        return CallResult(None, e)
+
+
+def call_concurrently(*calls, inline=None):
+    # Run independent stripe calls at once on the fan-out pool. inline runs
+    # on the calling thread meanwhile, for work that touches the database.
+    # Results keep the order of calls (inline last), failures are returned
+    # in CallResult.error instead of raised.
+    context = (current_request(), current_profile(), current_priority())
+    futures = [get_fanout_executor().submit(_run_bound, context, _call_one, func) for func in calls]
+    results = [_call_one(inline)] if inline is not None else []
+    return [future.result() for future in futures] + results
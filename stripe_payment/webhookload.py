@@ -0,0 +1,251 @@
+import itertools
+import json
+import random
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import Client
+from django.urls import reverse
+
+from .benchmark import percentile
+from .fakestripe import sign_payload
+from .models import StripePayment, StripeWebhookEvent
+from .webhooks import process_events
+
+# Renewal-day rehearsal: builds charge.succeeded / customer.subscription.updated
+# events, delivers them signed to stripe_webhooks with duplicates and out of
+# order, then checks the stripe payment rows against what the events imply.
+
+PERIOD = 30 * 24 * 3600
+
+_serial = itertools.count(1)
+
+
+def new_id(prefix):
+    return '%s_load_%s' % (prefix, next(_serial))
+
+
+def event_payload(event_type, obj, created):
+    return {
+        'id': new_id('evt'),
+        'object': 'event',
+        'type': event_type,
+        'created': created,
+        'livemode': False,
+        'pending_webhooks': 1,
+        'data': {'object': obj}
+    }
+
+
+def charge_succeeded_event(customer_id, subscription_id, period_end, created):
+    # invoice and subscription come expanded so the handler needs no stripe call
+    return event_payload('charge.succeeded', {
+        'id': new_id('ch'),
+        'object': 'charge',
+        'customer': customer_id,
+        'amount': 9900,
+        'currency': 'usd',
+        'paid': True,
+        'status': 'succeeded',
+        'invoice': {
+            'id': new_id('in'),
+            'object': 'invoice',
+            'customer': customer_id,
+            'subscription': {'id': subscription_id, 'object': 'subscription', 'current_period_end': period_end},
+            'lines': {'object': 'list', 'data': [{'period': {'start': period_end - PERIOD, 'end': period_end}}]}
+        }
+    }, created)
+
+
+def subscription_updated_event(customer_id, subscription_id, period_end, created):
+    return event_payload('customer.subscription.updated', {
+        'id': subscription_id,
+        'object': 'subscription',
+        'customer': customer_id,
+        'status': 'active',
+        'current_period_start': period_end - PERIOD,
+        'current_period_end': period_end
+    }, created)
+
+
+def build_events(customers, renewals=1, start=None):
+    # customers is a list of (customer_id, subscription_id)
+    start = int(time.time()) if start is None else start
+    events = []
+    for index, (customer_id, subscription_id) in enumerate(customers):
+        for renewal in range(renewals):
+            created = start + renewal * PERIOD + index
+            period_end = start + (renewal + 1) * PERIOD
+            events.append(charge_succeeded_event(customer_id, subscription_id, period_end, created))
+            events.append(subscription_updated_event(customer_id, subscription_id, period_end, created + 1))
+    events.sort(key=lambda event: event['created'])
+    return events
+
+
+def deliveries(events, duplicates=0.0, disorder=0.0, window=10, seed=None):
+    # Stripe delivers at least once and in no particular order.
+    rnd = random.Random(seed)
+    delivered = []
+    for position, event in enumerate(events):
+        delivered.append((position, event))
+        if rnd.random() < duplicates:
+            delivered.append((position + rnd.uniform(0, window), event))
+    delivered = [event for position, event in sorted(delivered, key=lambda item: item[0])]
+    for index in range(len(delivered)):
+        if rnd.random() < disorder:
+            other = min(len(delivered) - 1, index + rnd.randint(1, window))
+            delivered[index], delivered[other] = delivered[other], delivered[index]
+    return delivered
+
+
+def save_events(path, events):
+    with open(path, 'w') as f:
+        for event in events:
+            f.write(json.dumps(event) + '\n')
+
+
+def load_events(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def event_subscription(event):
+    obj = event['data']['object']
+    if obj.get('object') == 'subscription':
+        return obj['customer'], obj['id'], obj['current_period_end']
+    if event['type'] == 'charge.succeeded' and isinstance(obj.get('invoice'), dict):
+        subscription = obj['invoice'].get('subscription')
+        if isinstance(subscription, dict):
+            return obj['customer'], subscription['id'], subscription['current_period_end']
+    return None
+
+
+def expected_state(events):
+    # State after applying every distinct event once in created order.
+    state = OrderedDict()
+    seen = set()
+    for event in sorted(events, key=lambda event: event['created']):
+        if event['id'] in seen:
+            continue
+        seen.add(event['id'])
+        subscription = event_subscription(event)
+        if subscription is None:
+            continue
+        customer_id, subscription_id, period_end = subscription
+        expected = state.setdefault(customer_id, {'subscription_id': subscription_id, 'paid_until': None,
+                                                  'no_of_subscriptions': 0, 'status': 1})
+        expected['paid_until'] = period_end
+        if event['type'] == 'charge.succeeded':
+            expected['no_of_subscriptions'] += 1
+    return state
+
+
+def create_customers(state):
+    # rows the events point at, on the throwaway database
+    User = get_user_model()
+    for customer_id, expected in state.items():
+        user = User.objects.create(**{
+            User.USERNAME_FIELD: 'load-%s' % customer_id,
+            'email': 'load-%s@example.com' % customer_id
+        })
+        StripePayment.objects.filter(user=user).update(customer_id=customer_id,
+                                                       subscription_id=expected['subscription_id'],
+                                                       status=1, paid_until=0)
+
+
+def check_state(state):
+    rows = StripePayment.objects.filter(customer_id__in=list(state)).values(
+        'customer_id', 'paid_until', 'no_of_subscriptions', 'status')
+    actual = {row['customer_id']: row for row in rows}
+    mismatches = []
+    for customer_id, expected in state.items():
+        row = actual.get(customer_id)
+        fields = ('paid_until', 'no_of_subscriptions', 'status')
+        if row is None or any(row[field] != expected[field] for field in fields):
+            mismatches.append((customer_id, {field: expected[field] for field in fields},
+                               row and {field: row[field] for field in fields}))
+    return mismatches
+
+
+class Sender(object):
+
+    def __init__(self, url=None, secret=None):
+        self.url = url
+        self.secret = secret or settings.STRIPE_WEBHOOK_SIGNING_KEY
+        self.session = requests.Session() if url else None
+        self.path = reverse('stripe_webhooks')
+
+    def send(self, event):
+        payload = json.dumps(event)
+        signature = sign_payload(payload, self.secret)
+        if self.session is not None:
+            return self.session.post(self.url, data=payload, timeout=30, headers={
+                'Content-Type': 'application/json', 'Stripe-Signature': signature
+            }).status_code
+        try:
+            return Client().post(self.path, payload, content_type='application/json',
+                                 HTTP_STRIPE_SIGNATURE=signature).status_code
+        finally:
+            connection.close()
+
+
+def fire(events, sender, rate=0, concurrency=1):
+    # rate is events per second over all threads, 0 sends as fast as possible
+    start = time.perf_counter()
+
+    def deliver(item):
+        index, event = item
+        if rate:
+            delay = start + index / float(rate) - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        sent = time.perf_counter()
+        try:
+            code = sender.send(event)
+        except Exception as e:
+            print(e)
+            code = None
+        return time.perf_counter() - sent, code
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='stripe-webhook-load') as executor:
+        timings = list(executor.map(deliver, enumerate(events)))
+    elapsed = time.perf_counter() - start
+    samples = [duration * 1000 for duration, code in timings]
+    return {
+        'sent': len(events),
+        'statuses': Counter(code for duration, code in timings),
+        'elapsed': elapsed,
+        'rps': len(events) / elapsed if elapsed else 0.0,
+        'p50': percentile(samples, 50),
+        'p95': percentile(samples, 95),
+        'p99': percentile(samples, 99),
+    }
+
+
+def drain(workers=None):
+    start = time.perf_counter()
+    processed, failed = process_events(workers=workers)
+    return {
+        'processed': processed,
+        'failed': failed,
+        'pending': StripeWebhookEvent.objects.filter(status='0').count(),
+        'elapsed': time.perf_counter() - start,
+    }
+
+
+def run_load(events, delivered, sender, rate=0, concurrency=1, workers=None, check=True):
+    state = expected_state(events)
+    if check:
+        create_customers(state)
+    report = {'delivery': fire(delivered, sender, rate, concurrency)}
+    if check:
+        if getattr(settings, 'STRIPE_WEBHOOK_ASYNC', False):
+            report['processing'] = drain(workers)
+        report['customers'] = len(state)
+        report['mismatches'] = check_state(state)
+    return report
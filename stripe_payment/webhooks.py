@@ -0,0 +1,335 @@
+import datetime
+import json
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import stripe
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Exists, F, OuterRef, Q
+from django.utils import timezone
+from django.utils.translation import ugettext_lazy as _
+from stripe.error import StripeError
+
+from .breaker import stripe_available
+from .cache import invalidate_entitlement
+from .eventlog import append_events, log_stored_event
+from .models import StripePayment, PaymentMethod, StripeWebhookEvent
+from .outbox import retry_delay
+from .utils import (retrieve_customer_subscription, latest_subscription_invoice, store_catalog_object,
+                    delete_catalog_object, payment_method_details)
+
+
+class WebhookError(Exception):
+
+    def __init__(self, message, retry=False):
+        super().__init__(message)
+        self.retry = retry
+
+
+def get_charge_period_end(charge, subscription_id, offline=False):
+    # One stripe call at most: the invoice with its subscription expanded, or
+    # the subscription itself for charges made outside an invoice. Invoices
+    # without a subscription are one-off payments and have no period. offline
+    # only looks at the charge, which may then be plain json, for replays
+    # that must not call stripe.
+    invoice = charge.get('invoice')
+    if invoice and not isinstance(invoice, str):
+        subscription = invoice.get('subscription')
+        if subscription and not isinstance(subscription, str):
+            return subscription['current_period_end']
+        if not subscription:
+            return None
+        return invoice['lines']['data'][0]['period']['end']
+    if offline:
+        return None
+    if invoice:
+        invoice = latest_subscription_invoice(invoice, expand=['subscription'])
+        if invoice.subscription:
+            return invoice.subscription.current_period_end
+        return None
+    if subscription_id:
+        return retrieve_customer_subscription(subscription_id)['current_period_end']
+    return None
+
+
+def is_current(event):
+    # rows whose last applied subscription event is not newer than this one
+    return Q(last_event_at__isnull=True) | Q(last_event_at__lte=event.get('created') or 0)
+
+
+# State transitions of the handlers, shared with the event log replay. They
+# take the row's STATE_FIELDS as a dict and return the ones that change.
+STATE_FIELDS = ['subscription_id', 'payment_method_id', 'paid_until', 'status', 'is_cancel', 'no_of_subscriptions',
+                'last_event_at']
+
+
+def charge_changes(state, period_end):
+    # Every charge counts, but only one paying a subscription period
+    # activates the row, and a late one must not move paid_until back.
+    changes = {'no_of_subscriptions': state['no_of_subscriptions'] + 1}
+    if period_end:
+        changes.update(paid_until=max(state['paid_until'] or 0, period_end), status=1)
+    return changes
+
+
+def is_current_state(state, subscription, created):
+    # the subscription the api view stored, and no newer event applied yet
+    return state['subscription_id'] == subscription['id'] and (
+        state['last_event_at'] is None or state['last_event_at'] <= (created or 0))
+
+
+def subscription_updated_changes(state, subscription, created):
+    if not is_current_state(state, subscription, created):
+        return {}
+    return {'paid_until': subscription['current_period_end'], 'status': 1, 'last_event_at': created}
+
+
+def subscription_deleted_changes(state, subscription, created):
+    if not is_current_state(state, subscription, created):
+        return {}
+    return {'payment_method_id': '', 'subscription_id': '', 'paid_until': 0, 'status': 0, 'is_cancel': 0,
+            'last_event_at': created}
+
+
+def apply_transition(customer_id, transition):
+    # The row stays locked from the read to the write, concurrent events of
+    # one customer can not both start from the same state. Returns the row
+    # and its changes, or None without a row.
+    with transaction.atomic():
+        state = StripePayment.objects.select_for_update().filter(customer_id=customer_id).values(
+            'pk', 'user_id', *STATE_FIELDS).first()
+        if state is None:
+            return None
+        changes = transition(state)
+        if changes:
+            StripePayment.objects.filter(pk=state['pk']).update(**changes)
+    return state, changes
+
+
+def charge_succeeded(event):
+    charge = event.data.object
+    if not charge.get('customer'):
+        raise WebhookError('This was one time payment[SP-173]')
+
+    stripe_customer = StripePayment.objects.filter(customer_id=charge.customer).first()
+    if stripe_customer is None:
+        raise WebhookError('User does not exit![SP-176]')
+
+    try:
+        current_period_end = get_charge_period_end(charge, stripe_customer.subscription_id)
+    except StripeError as e:
+        raise WebhookError(_(e.user_message + '[SP-174]'), retry=True)
+    except Exception as e:
+        raise WebhookError(_(str(e) + '[SP-175]'), retry=True)
+
+    apply_transition(charge.customer, lambda state: charge_changes(state, current_period_end))
+    invalidate_entitlement(stripe_customer.user_id)
+
+
+def subscription_updated(event):
+    try:
+        subscription = event.data.object
+        applied = apply_transition(subscription.customer,
+                                   lambda state: subscription_updated_changes(state, subscription, event.get('created')))
+        if applied and applied[1]:
+            invalidate_entitlement(applied[0]['user_id'])
+    except Exception as e:
+        raise WebhookError(_(str(e) + '[SP-176]'), retry=True)
+
+
+def subscription_deleted(event):
+    try:
+        subscription = event.data.object
+        applied = apply_transition(subscription.customer,
+                                   lambda state: subscription_deleted_changes(state, subscription, event.get('created')))
+        if applied:
+            invalidate_entitlement(applied[0]['user_id'])
+    except Exception as e:
+        raise WebhookError(_(str(e) + '[SP-177]'), retry=True)
+
+
+def customer_deleted(event):
+    try:
+        customer_id = event.data.object.id
+        stripe_cus = StripePayment.objects.filter(customer_id=customer_id).first()
+        if stripe_cus is None:
+            return
+        PaymentMethod.objects.filter(user_id=stripe_cus.user_id).delete()
+        stripe_cus.delete()
+        invalidate_entitlement(stripe_cus.user_id)
+    except Exception as e:
+        raise WebhookError(_(str(e) + '[SP-178]'), retry=True)
+
+
+def trial_will_end(event):
+    # pending
+    print('trial will end')
+
+
+def catalog_updated(event):
+    store_catalog_object(event.data.object)
+
+
+def catalog_deleted(event):
+    delete_catalog_object(event.data.object.id)
+
+
+def payment_method_updated(event):
+    payment_method = event.data.object
+    PaymentMethod.objects.filter(payment_method_id=payment_method.id).update(**payment_method_details(payment_method))
+
+
+EVENT_HANDLERS = {
+    'charge.succeeded': charge_succeeded,
+    'customer.subscription.created': subscription_updated,
+    'customer.subscription.updated': subscription_updated,
+    'customer.subscription.deleted': subscription_deleted,
+    'customer.deleted': customer_deleted,
+    'customer.subscription.trial_will_end': trial_will_end,
+    'price.created': catalog_updated,
+    'price.updated': catalog_updated,
+    'price.deleted': catalog_deleted,
+    'product.created': catalog_updated,
+    'product.updated': catalog_updated,
+    'product.deleted': catalog_deleted,
+    'payment_method.updated': payment_method_updated,
+    'payment_method.automatically_updated': payment_method_updated,
+}
+
+
+def handle_event(event):
+    handler = EVENT_HANDLERS.get(event.type)
+    if handler is not None:
+        handler(event)
+
+
+def get_event_customer_id(event):
+    obj = event.data.object
+    if obj.get('object') == 'customer':
+        return obj.id
+    return obj.get('customer') or ''
+
+
+def get_shard(customer_id):
+    return zlib.crc32(customer_id.encode('utf-8')) % getattr(settings, 'STRIPE_WEBHOOK_SHARDS', 16)
+
+
+def store_event(event, payload):
+    # Stripe retries deliveries, the unique event id drops the duplicates.
+    customer_id = get_event_customer_id(event)
+    stored, created = StripeWebhookEvent.objects.get_or_create(
+        event_id=event.id,
+        defaults={
+            'type': event.type,
+            'customer_id': customer_id,
+            'shard': get_shard(customer_id),
+            'created': event.get('created') or 0,
+            'payload': payload,
+        }
+    )
+    return stored, created
+
+
+def claim_events(batch_size, shards=None):
+    lease = datetime.timedelta(seconds=getattr(settings, 'STRIPE_WEBHOOK_LEASE', 300))
+    now = timezone.now()
+    # An earlier event of the customer waiting for its retry, or leased to
+    # another worker, holds back the later ones so they do not overtake it.
+    waiting = StripeWebhookEvent.objects.filter(
+        Q(created__lt=OuterRef('created')) | Q(created=OuterRef('created'), id__lt=OuterRef('id')),
+        status='0', shard=OuterRef('shard'), customer_id=OuterRef('customer_id'), available_at__gt=now
+    ).exclude(customer_id='')
+    with transaction.atomic():
+        pending = StripeWebhookEvent.objects.select_for_update(skip_locked=True).filter(
+            ~Exists(waiting), status='0', available_at__lte=now)
+        if shards is not None:
+            pending = pending.filter(shard__in=shards)
+        events = list(pending.order_by('created', 'id')[:batch_size])
+        StripeWebhookEvent.objects.filter(pk__in=[event.pk for event in events]).update(available_at=now + lease)
+    return events
+
+
+# Handlers that only write the latest subscription state; several pending
+# events of one subscription collapse into the newest.
+COALESCED_EVENTS = {'customer.subscription.created', 'customer.subscription.updated'}
+
+
+def coalesce_events(events):
+    # events are one customer's, in created order. Returns the events to
+    # apply and the pks of the superseded ones.
+    newest = {}
+    for stored in events:
+        if stored.type in COALESCED_EVENTS:
+            subscription_id = json.loads(stored.payload)['data']['object']['id']
+            newest[subscription_id] = stored.pk
+    keep = set(newest.values())
+    superseded = {stored.pk for stored in events if stored.type in COALESCED_EVENTS and stored.pk not in keep}
+    return [stored for stored in events if stored.pk not in superseded], superseded
+
+
+def _process_customer_events(events):
+    # Events of one customer run in order. After a failure the rest of the
+    # group is released so it is not applied ahead of the failed event;
+    # claim_events holds back the ones of later batches.
+    max_attempts = getattr(settings, 'STRIPE_WEBHOOK_MAX_ATTEMPTS', 8)
+    processed = failed = 0
+    logged = []
+    try:
+        applied, superseded = coalesce_events(events)
+        if superseded:
+            StripeWebhookEvent.objects.filter(pk__in=superseded).update(status='1', attempts=F('attempts') + 1,
+                                                                        last_error='', updated_at=timezone.now())
+            processed += len(superseded)
+            # never applied, but still part of the history
+            logged += [stored for stored in events if stored.pk in superseded]
+        events = applied
+        for index, stored in enumerate(events):
+            try:
+                event = stripe.Event.construct_from(json.loads(stored.payload), stripe.api_key)
+                handle_event(event)
+            except Exception as e:
+                # failing fast while stripe is down does not use up an attempt
+                attempts = stored.attempts + (1 if stripe_available() else 0)
+                retry = getattr(e, 'retry', True) and attempts < max_attempts
+                delay = retry_delay(attempts)
+                StripeWebhookEvent.objects.filter(pk=stored.pk).update(status='0' if retry else '-1',
+                                                                       attempts=attempts,
+                                                                       available_at=timezone.now() + delay,
+                                                                       last_error=str(e),
+                                                                       updated_at=timezone.now())
+                failed += 1
+                if retry:
+                    StripeWebhookEvent.objects.filter(pk__in=[later.pk for later in events[index + 1:]]).update(
+                        available_at=timezone.now() + delay)
+                    break
+                continue
+            StripeWebhookEvent.objects.filter(pk=stored.pk).update(status='1', attempts=stored.attempts + 1,
+                                                                   last_error='', updated_at=timezone.now())
+            processed += 1
+            logged.append(stored)
+        if logged:
+            append_events([log_stored_event(stored) for stored in logged])
+    finally:
+        connection.close()
+    return processed, failed
+
+
+def process_events(batch_size=None, workers=None, shards=None, max_batches=None):
+    batch_size = batch_size or getattr(settings, 'STRIPE_WEBHOOK_BATCH_SIZE', 200)
+    workers = workers or getattr(settings, 'STRIPE_WEBHOOK_WORKERS', 8)
+    processed = failed = batches = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='stripe-webhooks') as executor:
+        while max_batches is None or batches < max_batches:
+            events = claim_events(batch_size, shards)
+            if not events:
+                break
+            batches += 1
+            by_customer = OrderedDict()
+            for stored in events:
+                by_customer.setdefault(stored.customer_id, []).append(stored)
+            for ok, ko in executor.map(_process_customer_events, by_customer.values()):
+                processed += ok
+                failed += ko
+    return processed, failed